@@ -1,15 +1,35 @@
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError, APITimeoutError
+import asyncio
+import httpx
 import logging
-from typing import List, Dict
-from config import PRICE_TIERS, DISPLAY, get_availability, OPENAI_API_KEY
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, List, Dict, Optional, Tuple
+from config import (PRICE_TIERS, DISPLAY, get_availability, inventory_version, OPENAI_API_KEY, HISTORY_TOKEN_BUDGET,
+                    OPENAI_MAX_INFLIGHT, OPENAI_POOL_SIZE, OPENAI_TIMEOUTS, OPENAI_MAX_RETRIES, OPENAI_RETRY_BASE_SEC,
+                    OPENAI_HEDGE_ENABLED, OPENAI_MODELS, OPENAI_ESCALATION_MODEL, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SEC)
+from tools import try_parse_order_json, missing_points_from_reply, detect_point4_items
+import metrics
 
 logger = logging.getLogger(__name__)
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Один спільний клієнт з явно заданим keep-alive пулом. Вбудовані ретраї SDK вимкнені —
+# повтори з джитером і хеджування робить _openai_chat.
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=OPENAI_POOL_SIZE, max_keepalive_connections=OPENAI_POOL_SIZE, keepalive_expiry=120),
+        timeout=httpx.Timeout(60, connect=5),
+    ),
+)
+# Глобальний ліміт одночасних запитів до OpenAI (чати обробляються паралельно)
+_openai_slots = asyncio.Semaphore(OPENAI_MAX_INFLIGHT)
 
 # ==== СИСТЕМНІ ПРОМПТИ ====
-def build_system_prompt() -> str:
-    
-    # --- Формуємо динамічний блок про наявність ---
+def _render_availability_block() -> str:
+    """Динамічний хвіст промпту: наявність країн. Єдина частина, що залежить від інвентарю."""
     available_items_prompt = []
     unavailable_items_prompt = []
     
@@ -23,7 +43,7 @@ def build_system_prompt() -> str:
             reason_text = reason or "немає в наявності"
             unavailable_items_prompt.append(f"{disp_name} (СТАТУС: {reason_text})")
 
-    availability_prompt_block = "\n\n=== АКТУАЛЬНА НАЯВНІСТЬ ===\n" \
+    availability_prompt_block = "=== АКТУАЛЬНА НАЯВНІСТЬ ===\n" \
                                 "Це ПОВНИЙ список товарів. Завжди перевіряй його перед тим, як приймати замовлення.\n"
     
     if available_items_prompt:
@@ -36,16 +56,16 @@ def build_system_prompt() -> str:
                                      "Якщо клієнт питає про ці країни, не показуй прайс, а кажи, що їх немає, вказуючи причину.\n" \
                                      "НЕ ПРИЙМАЙ замовлення на ці позиції.\n"
     
-    availability_prompt_block += "\n"
-    # --- Кінець блоку про наявність ---
+    return availability_prompt_block
 
+def _render_static_rules() -> str:
     return (
         # === РОЛЬ ТА КОНТЕКСТ ===
         "Ти — дружелюбний і корисний Telegram-бот в інтернет-магазині SIM-карт. "
         "Чітко та суворо дотримуйся прописаних інструкцій, якщо щось не зрозуміло, то не вигадуй, а краще перепитай клієнта що він мав на увазі.\n"
-        
-        # (ВСТАВЛЯЄМО ДИНАМІЧНИЙ БЛОК ТУТ)
-        + availability_prompt_block +
+        "Актуальна наявність товарів наведена в кінці цих інструкцій, у блоці «АКТУАЛЬНА НАЯВНІСТЬ».\n"
+        "Записи в історії виду «[Прайс надіслано клієнту вище: ...]» та «[Оформлене замовлення] ...» — це стислий запис того, "
+        "що бот уже надіслав клієнту (прайс або фінальне зведення замовлення). Ніколи не відповідай у такому форматі сам.\n\n"
 
         "На початку чату клієнт уже отримує від акаунта власника перелік країн у наявності, цін на сім-карти цих країн та інформацію для доставки — ти це НЕ ДУБЛЮЄШ. "
         "Уважно все перевіряєш, якщо клієнт запитав про ціни, а ти бачиш, що перелік цін був в одному з останніх трьох повідомлень, то просто вказуєш, що перелік цін вище. "
@@ -157,8 +177,13 @@ def build_system_prompt() -> str:
         "Якщо користувач запитує ПРО ЦІНИ або про наявність — ВІДПОВІДАЙ ЛИШЕ JSON:\n"
         "{\n"
         '  "ask_prices": true,\n'
-        '  "countries": ["ALL" або перелік ключів, напр. "ВЕЛИКОБРИТАНІЯ"]\n'
-        "}\n\n"
+        '  "countries": ["ALL" або перелік ключів, напр. "ВЕЛИКОБРИТАНІЯ"],\n'
+        '  "followup": "коротка відповідь на ІНШІ частини повідомлення або порожній рядок",\n'
+        '  "ussd_targets": [ {"country":"КРАЇНА","operator":"Опціонально"} ]\n'
+        "}\n"
+        "Прайс бекенд надішле сам. У `followup` НЕ повторюй ціни і НЕ пиши шаблонні підтвердження наявності; "
+        "якщо просили ЛИШЕ ціну/прайс — `followup` має бути порожнім рядком. "
+        "`ussd_targets` заповнюй лише якщо в тому ж повідомленні питають, як дізнатися номер; інакше — порожній масив.\n\n"
 
         # === ДОВІДКА USSD ===
         "Якщо користувач запитує, як дізнатися/перевірити свій номер на SIM — ВІДПОВІДАЙ ЛИШЕ JSON:\n"
@@ -255,7 +280,12 @@ def build_system_prompt() -> str:
         "НЕ згадуй США у відповіді на запит про Україну.\n\n"
     )
 
-def build_followup_prompt() -> str:
+def _render_system_prompt() -> str:
+    # Спершу великий статичний блок правил, динамічна наявність — в самому кінці.
+    # Зміна стоку не зсуває префікс, і кеш промптів на боці OpenAI продовжує спрацьовувати.
+    return _render_static_rules() + _render_availability_block()
+
+def _render_followup_prompt() -> str:
     return (
         "Прайс або інше повідомлення щойно надіслано окремо. "
         "Відповідай КОРОТКО на інші частини останнього повідомлення, що НЕ стосуються вже надісланих даних.\n\n"
@@ -268,14 +298,14 @@ def build_followup_prompt() -> str:
         "}\n"
     )
 
-def build_force_point4_prompt() -> str:
+def _render_force_point4_prompt() -> str:
     return (
         "У контексті вже є пункти 1–3 (ПІБ, телефон, місто+№).\n"
         "Останнє повідомлення, включно з процитованим, ймовірно містить лише пункт 4 (країни та кількість).\n"
         "Витягни пункт 4, поєднай з 1–3 з контексту і ПОВЕРНИ ЛИШЕ ПОВНИЙ JSON замовлення."
     )
 
-def build_manager_parser_prompt() -> str:
+def _render_manager_parser_prompt() -> str:
     country_keys = ", ".join(f'"{k}"' for k in PRICE_TIERS.keys())
     return (
         "Ти — сервіс для вилучення даних. "
@@ -317,75 +347,353 @@ def build_manager_parser_prompt() -> str:
         "}"
     )
 
-# ==== OpenAI Виклики ====
-async def _openai_chat(messages: List[Dict[str, str]], temp=0.2, json_mode=False) -> str:
-    try:
-        kwargs = {
-            "model": "gpt-4o",
-            "messages": messages,
-            "max_tokens": 600,
-            "temperature": temp,
+# ==== Кеш промптів ====
+# Промпти залежать лише від PRICE_TIERS / COUNTRY_AVAILABILITY, тому рендеримо їх один раз
+# на версію інвентарю. Байт-в-байт однаковий префікс потрібен і для кешу промптів на боці OpenAI.
+_prompt_cache: Tuple[Optional[str], Dict[str, str]] = (None, {})
+
+def _get_prompts() -> Dict[str, str]:
+    global _prompt_cache
+    version = inventory_version()
+    if _prompt_cache[0] != version:
+        prompts = {
+            "main": _render_system_prompt(),
+            "followup": _render_followup_prompt(),
+            "force_point4": _render_force_point4_prompt(),
+            "manager_parser": _render_manager_parser_prompt(),
         }
-        if json_mode: kwargs["response_format"] = {"type": "json_object"}
-        response = await client.chat.completions.create(**kwargs)
-        return response.choices[0].message.content or ""
-    except Exception as e:
-        logger.error(f"OpenAI Error: {e}")
-        return ""
+        _prompt_cache = (version, prompts)  # атомарна заміна — читачі бачать або старий, або новий набір
+        logger.info(f"Prompt cache rebuilt for inventory version {version}")
+    return _prompt_cache[1]
+
+def invalidate_prompt_cache() -> None:
+    """Примусово скидає кеш промптів (наступний виклик перерендерить їх) разом із кешем відповідей."""
+    global _prompt_cache
+    _prompt_cache = (None, {})
+    response_cache.clear()
+
+def build_system_prompt() -> str:
+    return _get_prompts()["main"]
+
+def build_followup_prompt() -> str:
+    return _get_prompts()["followup"]
+
+def build_force_point4_prompt() -> str:
+    return _get_prompts()["force_point4"]
+
+def build_manager_parser_prompt() -> str:
+    return _get_prompts()["manager_parser"]
+
+# ==== Кеш відповідей на типові запитання ====
+# «ціна на англію», «скільки коштує німеччина» тощо — однаковий текст без історії чату дає однакову
+# відповідь GPT. Ключ — нормалізований текст, тож кешуються лише перші повідомлення в чаті (див. main);
+# кеш скидається при зміні версії інвентарю.
+_CACHE_KEY_RE = re.compile(r"\w+")
+
+def _cache_key(text: str) -> str:
+    return " ".join(_CACHE_KEY_RE.findall(text.lower().replace("ё", "е")))
+
+def _is_cacheable_reply(reply: str) -> bool:
+    """Кешуємо лише відповіді, що не залежать від даних клієнта: не замовлення і не дозбір пунктів."""
+    if not reply or reply.lstrip().startswith("🛒"): return False
+    if try_parse_order_json(reply): return False
+    return not missing_points_from_reply(reply)
+
+class ResponseCache:
+    """LRU + TTL кеш відповідей GPT на запитання без контексту замовлення."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size, self.ttl = max_size, ttl
+        self._items: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._version: Optional[str] = None
+
+    def _check_version(self) -> None:
+        version = inventory_version()
+        if version != self._version:
+            self._items.clear()  # ціни/наявність змінились — старі відповіді неактуальні
+            self._version = version
+
+    def get(self, text: str) -> Optional[str]:
+        if self.max_size <= 0: return None
+        self._check_version()
+        key = _cache_key(text)
+        hit = self._items.get(key)
+        if hit and time.monotonic() - hit[0] <= self.ttl:
+            self._items.move_to_end(key)
+            metrics.RESPONSE_CACHE.inc({"result": "hit"})
+            return hit[1]
+        if hit: del self._items[key]
+        metrics.RESPONSE_CACHE.inc({"result": "miss"})
+        return None
+
+    def put(self, text: str, reply: str) -> None:
+        if self.max_size <= 0 or not _is_cacheable_reply(reply): return
+        self._check_version()
+        key = _cache_key(text)
+        if not key: return
+        self._items[key] = (time.monotonic(), reply)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SEC)
+
+# ==== Статистика використання токенів ====
+# Накопичувальні лічильники по типах викликів: скільки токенів промпту прийшло з кешу OpenAI.
+USAGE_STATS: Dict[str, Dict[str, float]] = {}
+
+def _record_usage(kind: str, response, elapsed: float) -> None:
+    usage = getattr(response, "usage", None)
+    if not usage: return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    prompt = usage.prompt_tokens or 0
+    st = USAGE_STATS.setdefault(kind, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "latency_sec": 0.0})
+    st["calls"] += 1
+    st["prompt_tokens"] += prompt
+    st["cached_tokens"] += cached
+    st["completion_tokens"] += usage.completion_tokens or 0
+    st["latency_sec"] += elapsed
+    metrics.observe_openai(kind, elapsed, prompt, cached, usage.completion_tokens or 0)
+    logger.info(f"OpenAI usage [{kind}]: prompt={prompt} cached={cached} completion={usage.completion_tokens} time={elapsed:.2f}s")
+
+def get_usage_stats() -> Dict[str, Dict[str, float]]:
+    """Знімок статистики з часткою кешованих токенів та середньою затримкою по кожному типу виклику."""
+    out = {}
+    for kind, st in USAGE_STATS.items():
+        row = dict(st)
+        row["cache_hit_rate"] = (st["cached_tokens"] / st["prompt_tokens"]) if st["prompt_tokens"] else 0.0
+        row["avg_latency_sec"] = (st["latency_sec"] / st["calls"]) if st["calls"] else 0.0
+        out[kind] = row
+    return out
+
+# ==== OpenAI Виклики ====
+class GPTCallFailed(Exception):
+    """OpenAI не дав відповіді після всіх повторних спроб (або помилка, яку не варто повторювати)."""
+
+class GPTStreamInterrupted(GPTCallFailed):
+    """Стрім обірвався після перших фрагментів — отриманий текст неповний, використовувати його не можна."""
+
+_latency: Dict[str, Deque[float]] = {}  # останні затримки по типах викликів — для p95 та хеджування
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, (APITimeoutError, APIConnectionError, asyncio.TimeoutError)): return True
+    if isinstance(e, APIStatusError): return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+def _retry_delay(e: Exception, attempt: int) -> float:
+    response = getattr(e, "response", None)
+    if response is not None:
+        try: return min(float(response.headers.get("retry-after")), 20.0)
+        except (TypeError, ValueError): pass
+    return OPENAI_RETRY_BASE_SEC * (2 ** attempt) * random.uniform(0.5, 1.5)  # експонента з джитером
+
+def latency_p95(kind: str) -> Optional[float]:
+    samples = _latency.get(kind)
+    if not samples or len(samples) < 20: return None
+    ordered = sorted(samples)
+    return ordered[int(len(ordered) * 0.95) - 1]
+
+async def _create_once(kind: str, kwargs: Dict):
+    async with _openai_slots:
+        started = time.monotonic()
+        response = await client.chat.completions.create(timeout=OPENAI_TIMEOUTS.get(kind, 30), **kwargs)
+    elapsed = time.monotonic() - started
+    _latency.setdefault(kind, deque(maxlen=200)).append(elapsed)
+    _record_usage(kind, response, elapsed)
+    return response
+
+async def _create_hedged(kind: str, kwargs: Dict):
+    """Якщо запит триває довше за p95 цього типу — шлемо дубль і беремо першу успішну відповідь."""
+    p95 = latency_p95(kind) if OPENAI_HEDGE_ENABLED else None
+    if p95 is None: return await _create_once(kind, kwargs)
+    primary = asyncio.ensure_future(_create_once(kind, kwargs))
+    done, _ = await asyncio.wait({primary}, timeout=p95)
+    if done: return primary.result()
+    logger.info(f"Hedging OpenAI [{kind}] request after {p95:.2f}s")
+    pending = {primary, asyncio.ensure_future(_create_once(kind, kwargs))}
+    errors = []
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending: other.cancel()
+                return task.result()
+            errors.append(task.exception())
+    raise errors[0]
+
+async def _openai_chat(messages: List[Dict[str, str]], temp=0.2, json_mode=False, kind="main", max_tokens=600,
+                       model: Optional[str] = None) -> str:
+    """Єдина точка виклику chat.completions: модель і таймаут за типом виклику, ретраї на 429/5xx, хеджування."""
+    kwargs = {
+        "model": model or OPENAI_MODELS.get(kind, OPENAI_ESCALATION_MODEL),
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temp,
+    }
+    if json_mode: kwargs["response_format"] = {"type": "json_object"}
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            response = await _create_hedged(kind, kwargs)
+            return (response.choices[0].message.content or "").strip()
+        except Exception as e:
+            if attempt >= OPENAI_MAX_RETRIES or not _is_retryable(e):
+                logger.error(f"OpenAI [{kind}] error after {attempt + 1} attempt(s): {e}")
+                metrics.OPENAI_ERRORS.inc({"kind": kind})
+                raise GPTCallFailed(str(e)) from e
+            delay = _retry_delay(e, attempt)
+            logger.warning(f"OpenAI [{kind}] {type(e).__name__}, retry in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    return ""
+
+# ==== Компактизація історії ====
+# Вхідні токени — головний чинник затримки та вартості. Перед викликом:
+# 1) прайси, які бот уже надіслав, замінюємо коротким плейсхолдером;
+# 2) зведення замовлень стискаємо в один рядок (дані лишаються — вони потрібні для редагування);
+# 3) якщо історія не влазить у HISTORY_TOKEN_BUDGET — старші репліки згортаємо у стислий зміст.
+_PRICE_ROW_RE = re.compile(r"шт\. — (\d+ грн|договірна)")
+_ORDER_ROW_RE = re.compile(r"шт — (\d+ грн|договірна|\(замовлення оплачене\))")
+_SUMMARY_MAX_CHARS = 500
+
+def estimate_tokens(text: str) -> int:
+    """Груба оцінка кількості токенів (для кирилиці ~3 символи на токен)."""
+    return len(text or "") // 3 + 1
+
+def _message_tokens(m: Dict[str, str]) -> int:
+    return estimate_tokens(m.get("content", "")) + 4  # +службові токени ролі
+
+def _compact_message(m: Dict[str, str]) -> Dict[str, str]:
+    if m.get("role") != "assistant": return m
+    text = m.get("content", "")
+    if len(_PRICE_ROW_RE.findall(text)) >= 2:
+        names = [DISPLAY[k] for k in PRICE_TIERS if k in DISPLAY and f" {DISPLAY[k]} " in text]
+        return {"role": "assistant", "content": f"[Прайс надіслано клієнту вище: {', '.join(names) or 'всі країни'}]"}
+    if _ORDER_ROW_RE.search(text):
+        lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+        return {"role": "assistant", "content": "[Оформлене замовлення] " + " | ".join(lines)}
+    return m
+
+def _summarize_dropped(dropped: List[Dict[str, str]]) -> str:
+    parts = []
+    for m in dropped:
+        text = " ".join((m.get("content") or "").split())
+        if m.get("role") == "user": parts.append(f"клієнт: {text[:120]}")
+        elif text.startswith("[Оформлене замовлення]"): parts.append(text[:200])
+    summary = "; ".join(parts)
+    if len(summary) > _SUMMARY_MAX_CHARS: summary = "…" + summary[-_SUMMARY_MAX_CHARS:]
+    return "[Стислий зміст попередньої частини діалогу] " + summary
+
+def compact_history(history: List[Dict[str, str]], user_payload: str, budget: int = HISTORY_TOKEN_BUDGET) -> List[Dict[str, str]]:
+    """Повертає нову (стиснуту) копію історії, яка разом з user_payload вкладається в budget токенів."""
+    msgs = [_compact_message(m) for m in history]
+    available = budget - estimate_tokens(user_payload)
+    if sum(_message_tokens(m) for m in msgs) <= available: return msgs
+
+    available -= estimate_tokens("x" * (_SUMMARY_MAX_CHARS + 60)) + 4  # місце під стислий зміст
+    kept, used = [], 0
+    for m in reversed(msgs):
+        t = _message_tokens(m)
+        if used + t > available: break
+        kept.append(m)
+        used += t
+    kept.reverse()
+    dropped = msgs[:len(msgs) - len(kept)]
+    logger.info(f"History compacted: dropped {len(dropped)} of {len(msgs)} messages (~{used} tokens kept)")
+    return [{"role": "system", "content": _summarize_dropped(dropped)}] + kept
 
 async def ask_gpt_main(history: List[Dict[str, str]], user_payload: str) -> str:
+    """Основна відповідь. При недоступності OpenAI кидає GPTCallFailed."""
     messages = [{"role": "system", "content": build_system_prompt()}]
-    messages.extend(history)
+    messages.extend(compact_history(history, user_payload))
     messages.append({"role": "user", "content": user_payload})
     return await _openai_chat(messages)
 
+async def stream_gpt_main(history: List[Dict[str, str]], user_payload: str) -> AsyncIterator[str]:
+    """Те саме, що ask_gpt_main, але віддає текст частинами в міру генерації (stream=True).
+    Повторює запит лише якщо помилка сталася до першого фрагмента; обрив після нього — GPTStreamInterrupted."""
+    messages = [{"role": "system", "content": build_system_prompt()}]
+    messages.extend(compact_history(history, user_payload))
+    messages.append({"role": "user", "content": user_payload})
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        started, yielded = time.monotonic(), False
+        try:
+            async with _openai_slots:
+                stream = await client.chat.completions.create(
+                    model=OPENAI_MODELS["main"],
+                    messages=messages,
+                    max_tokens=600,
+                    temperature=0.2,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=OPENAI_TIMEOUTS.get("main", 30),
+                )
+                async for chunk in stream:
+                    if chunk.usage: _record_usage("main", chunk, time.monotonic() - started)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yielded = True
+                        yield chunk.choices[0].delta.content
+            return
+        except Exception as e:
+            if yielded:
+                logger.error(f"OpenAI stream broke mid-reply: {e}")
+                metrics.OPENAI_ERRORS.inc({"kind": "main"})
+                raise GPTStreamInterrupted(str(e)) from e
+            if attempt >= OPENAI_MAX_RETRIES or not _is_retryable(e):
+                logger.error(f"OpenAI [main/stream] error after {attempt + 1} attempt(s): {e}")
+                metrics.OPENAI_ERRORS.inc({"kind": "main"})
+                raise GPTCallFailed(str(e)) from e
+            delay = _retry_delay(e, attempt)
+            logger.warning(f"OpenAI [main/stream] {type(e).__name__}, retry in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
 async def ask_gpt_followup(history: List[Dict[str, str]], user_payload: str) -> str:
     messages = [{"role": "system", "content": build_followup_prompt()}]
     tail = history[-4:] if len(history) > 4 else history[:]
     messages.extend(tail)
     messages.append({"role": "user", "content": user_payload})
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=300,
-            temperature=0.2,
-        )
-        return (response.choices[0].message.content or "").strip()
-    except Exception as e:
-        logger.error(f"Помилка follow-up до OpenAI: {e}")
-        return ""
+        return await _openai_chat(messages, temp=0.2, kind="followup", max_tokens=300)
+    except GPTCallFailed:
+        return ""  # follow-up необов'язковий — прайс уже надіслано
+
+def _is_complete_order(text: str) -> bool:
+    order = try_parse_order_json(text)
+    return bool(order and order.items and all([order.full_name, order.phone, order.city, order.np]))
+
+def _has_order_items(text: str) -> bool:
+    order = try_parse_order_json(text)
+    return bool(order and order.items)
+
+async def _extract_with_escalation(messages: List[Dict[str, str]], kind: str, validate, json_mode=False) -> str:
+    """Витяг даних дешевою моделлю; якщо результат не проходить валідацію — повтор великою моделлю."""
+    out = await _openai_chat(messages, temp=0.1, json_mode=json_mode, kind=kind, max_tokens=500)
+    small = OPENAI_MODELS.get(kind, OPENAI_ESCALATION_MODEL)
+    if validate(out) or small == OPENAI_ESCALATION_MODEL: return out
+    logger.info(f"OpenAI [{kind}] {small} output failed validation — escalating to {OPENAI_ESCALATION_MODEL}")
+    return await _openai_chat(messages, temp=0.1, json_mode=json_mode, kind=kind, max_tokens=500, model=OPENAI_ESCALATION_MODEL)
 
 async def ask_gpt_force_point4(history: List[Dict[str, str]], user_payload: str) -> str:
     messages = [{"role": "system", "content": build_force_point4_prompt()}]
-    messages.extend(history)
+    messages.extend(compact_history(history, user_payload))
     messages.append({"role": "user", "content": user_payload})
+    # Без кількості й країни в повідомленні повного замовлення не буде ні в якої моделі — ескалація
+    # лише додала б ще один послідовний виклик перед основним
+    validate = _is_complete_order if detect_point4_items(user_payload) else (lambda _: True)
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.1,
-        )
-        return (response.choices[0].message.content or "").strip()
-    except Exception as e:
-        logger.error(f"Помилка force-point4 до OpenAI: {e}")
-        return ""
+        return await _extract_with_escalation(messages, "force_point4", validate)
+    except GPTCallFailed:
+        return ""  # далі спрацює основний виклик
 
 async def ask_gpt_to_parse_manager_order(text: str) -> str:
+    """Розбір замовлення менеджера. При недоступності OpenAI кидає GPTCallFailed."""
     messages = [
         {"role": "system", "content": build_manager_parser_prompt()},
         {"role": "user", "content": text}
     ]
-    try:
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.1,
-            response_format={"type": "json_object"}
-        )
-        return response.choices[0].message.content or ""
-    except Exception as e:
-        logger.error(f"Помилка GPT-парсера для менеджера: {e}")
-        return ""
+    return await _extract_with_escalation(messages, "manager_parser", _has_order_items, json_mode=True)
@@ -0,0 +1,237 @@
+"""Офлайн-бенчмарк handle_message: відтворює розмови з заглушками OpenAI і Telegram.
+
+Приклади:
+    python bench.py                          # синтетичні розмови, 50 чатів, затримка GPT 0.8 с
+    python bench.py --chats 200 --gpt-latency 1.5 --tg-latency 0.1
+    python bench.py --replay convs.jsonl     # рядки {"chat_id": 1, "text": "..."} у порядку надходження
+
+Звіт: час на повідомлення по етапах (GPT / Telegram / власний код), викликів GPT і Telegram
+на повідомлення, пропускна здатність (повідомлень/с) при N паралельних чатах, приріст пам'яті.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict, List
+
+SYNTHETIC_CONVERSATIONS = [
+    ["Привіт", "ціна англія", "Іван Франко 0991234567", "Київ 25", "англія 2 шт"],
+    ["прайс", "як дізнатись номер німеччина", "дякую"],
+    ["скільки коштує німеччина і чехія?", "а сім-карти нові?", "Петро Мельник 0671112233 Львів 12 німеччина 3"],
+    ["Добрий день, а як активувати сімку?", "ок"],
+    ["Олена Шевчук 0505556677 Одеса поштомат 35628 польща 1", "оплата криптою"],
+]
+
+# ==== Заглушка OpenAI ====
+_PHONE_RE = re.compile(r"\d{9,12}")
+
+def _canned_reply(messages: List[Dict[str, str]]) -> str:
+    system = messages[0]["content"] if messages else ""
+    last = (messages[-1]["content"] if messages else "").lower()
+    if system.startswith("Ти — сервіс для вилучення даних") or _PHONE_RE.search(last):
+        return json.dumps({"full_name": "Іван Франко", "phone": "0991234567", "city": "Київ", "np": "25",
+                           "items": [{"country": "ВЕЛИКОБРИТАНІЯ", "qty": 2}]}, ensure_ascii=False)
+    if "ціна" in last or "прайс" in last or "коштує" in last:
+        return json.dumps({"ask_prices": True, "countries": ["ALL"], "followup": ""}, ensure_ascii=False)
+    if "номер" in last:
+        return json.dumps({"ask_ussd": True, "targets": [{"country": "НІМЕЧЧИНА"}]}, ensure_ascii=False)
+    if "крипт" in last:
+        return json.dumps({"crypto_payment": True})
+    return "Просто вставте сім-карту в телефон і зачекайте, поки вона підключиться до мережі. Якщо мережа не з'явилась — виберіть її вручну в налаштуваннях."
+
+def _usage(messages, text):
+    prompt = sum(len(m["content"]) for m in messages) // 3
+    return SimpleNamespace(prompt_tokens=prompt, completion_tokens=len(text) // 3,
+                           prompt_tokens_details=SimpleNamespace(cached_tokens=int(prompt * 0.8)))
+
+class _FakeStream:
+    def __init__(self, stats, text, usage, chunk_delay):
+        self.stats, self.text, self.usage, self.chunk_delay = stats, text, usage, chunk_delay
+
+    async def __aiter__(self):
+        for i in range(0, len(self.text), 12):
+            started = time.perf_counter()
+            await asyncio.sleep(self.chunk_delay)
+            self.stats.gpt_time += time.perf_counter() - started
+            delta = SimpleNamespace(content=self.text[i:i + 12])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        yield SimpleNamespace(choices=[], usage=self.usage)
+
+class FakeOpenAI:
+    def __init__(self, stats, latency: float, jitter: float):
+        self.stats, self.latency, self.jitter = stats, latency, jitter
+
+    async def create(self, **kwargs):
+        started = time.perf_counter()
+        self.stats.gpt_calls += 1
+        text = _canned_reply(kwargs["messages"])
+        usage = _usage(kwargs["messages"], text)
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        if kwargs.get("stream"):
+            # час до першого фрагмента ~ третина повної затримки, решта — рівномірно по фрагментах
+            await asyncio.sleep(delay / 3)
+            self.stats.gpt_time += time.perf_counter() - started
+            return _FakeStream(self.stats, text, usage, (delay * 2 / 3) / max(1, len(text) // 12))
+        await asyncio.sleep(delay)
+        self.stats.gpt_time += time.perf_counter() - started
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+
+# ==== Заглушка Telegram ====
+class FakeTelegram:
+    def __init__(self, stats, latency: float):
+        self.stats, self.latency = stats, latency
+        self._next_id = 1000
+
+    async def call(self, chat_id, text=None):
+        started = time.perf_counter()
+        self.stats.tg_calls += 1
+        await asyncio.sleep(self.latency)
+        self.stats.tg_time += time.perf_counter() - started
+        self._next_id += 1
+        return FakeMessage(self, SimpleNamespace(id=chat_id, type="private"), text or "", self._next_id)
+
+class FakeMessage:
+    def __init__(self, tg, chat, text, message_id, from_user=None):
+        self._tg, self.chat, self.text, self.message_id = tg, chat, text, message_id
+        self.from_user = from_user
+        self.caption = None
+        self.reply_to_message = None
+        self.business_connection_id = "bench"
+
+    async def reply_text(self, text, **kwargs):
+        return await self._tg.call(self.chat.id, text)
+
+    async def edit_text(self, text, **kwargs):
+        return await self._tg.call(self.chat.id, text)
+
+    async def delete(self):
+        await self._tg.call(self.chat.id)
+        return True
+
+class FakeBot:
+    def __init__(self, tg):
+        self._tg = tg
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._tg.call(chat_id, text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._tg.call(chat_id)
+        return True
+
+class Stats:
+    def __init__(self):
+        self.gpt_calls = self.tg_calls = 0
+        self.gpt_time = self.tg_time = 0.0
+        self.latencies: List[float] = []
+
+# ==== Прогін ====
+async def _run_chat(main, tg, bot, chat_id: int, texts: List[str], chat_data: dict, stats: Stats):
+    user = SimpleNamespace(id=chat_id, username=f"client{chat_id}")
+    chat = SimpleNamespace(id=chat_id, type="private")
+    for i, text in enumerate(texts):
+        msg = FakeMessage(tg, chat, text, i + 1, from_user=user)
+        update = SimpleNamespace(effective_message=msg, effective_chat=chat, effective_user=user)
+        context = SimpleNamespace(chat_data=chat_data, bot=bot)
+        started = time.perf_counter()
+        await main.handle_message(update, context)
+        stats.latencies.append(time.perf_counter() - started)
+
+def _load_replay(path: str) -> Dict[int, List[str]]:
+    convs: Dict[int, List[str]] = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                convs[int(row["chat_id"])].append(row["text"])
+    return dict(convs)
+
+def _pct(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+async def run(args) -> Dict[str, float]:
+    import ai
+    import main
+
+    stats = Stats()
+    ai.client.chat.completions.create = FakeOpenAI(stats, args.gpt_latency, args.gpt_jitter).create
+    tg = FakeTelegram(stats, args.tg_latency)
+    bot = FakeBot(tg)
+
+    if args.replay:
+        convs = _load_replay(args.replay)
+    else:
+        convs = {cid: SYNTHETIC_CONVERSATIONS[cid % len(SYNTHETIC_CONVERSATIONS)] for cid in range(1, args.chats + 1)}
+    chat_data = {cid: {} for cid in convs}
+
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    await asyncio.gather(*(_run_chat(main, tg, bot, cid, texts, chat_data[cid], stats) for cid, texts in convs.items()))
+    wall = time.perf_counter() - started
+    mem_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    n = len(stats.latencies)
+    total = sum(stats.latencies)
+    return {
+        "chats": len(convs),
+        "messages": n,
+        "wall_sec": wall,
+        "msgs_per_sec": n / wall if wall else 0.0,
+        "latency_avg_sec": total / n if n else 0.0,
+        "latency_p50_sec": _pct(stats.latencies, 0.50),
+        "latency_p95_sec": _pct(stats.latencies, 0.95),
+        "stage_gpt_sec_per_msg": stats.gpt_time / n if n else 0.0,
+        "stage_telegram_sec_per_msg": stats.tg_time / n if n else 0.0,
+        "stage_own_sec_per_msg": max(0.0, total - stats.gpt_time - stats.tg_time) / n if n else 0.0,
+        "gpt_calls_per_msg": stats.gpt_calls / n if n else 0.0,
+        "telegram_calls_per_msg": stats.tg_calls / n if n else 0.0,
+        "memory_growth_kb": (mem_after - mem_before) / 1024,
+        "memory_per_chat_kb": (mem_after - mem_before) / 1024 / max(1, len(convs)),
+        "latency_stdev_sec": statistics.pstdev(stats.latencies) if n > 1 else 0.0,
+    }
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=50, help="кількість паралельних синтетичних чатів")
+    parser.add_argument("--replay", help="JSONL з записаними розмовами ({chat_id, text} на рядок)")
+    parser.add_argument("--gpt-latency", type=float, default=0.8, help="затримка заглушки OpenAI, с")
+    parser.add_argument("--gpt-jitter", type=float, default=0.2)
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="затримка одного виклику Telegram API, с")
+    parser.add_argument("--coalesce", type=float, default=0.0, help="COALESCE_WINDOW_SEC для прогону (0 — вимкнено)")
+    parser.add_argument("--no-stream", action="store_true", help="вимкнути стрімінг відповідей")
+    parser.add_argument("--json", action="store_true", help="вивести результат у JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # Конфіг читається при імпорті — виставляємо до import main
+    os.environ.setdefault("OPENAI_API_KEY", "bench-stub")
+    os.environ["COALESCE_WINDOW_SEC"] = str(args.coalesce)
+    os.environ["STREAMING_ENABLED"] = "0" if args.no_stream else "1"
+    os.environ.setdefault("CHAT_DB_PATH", ":memory:")
+    os.environ.setdefault("ORDER_DB_PATH", ":memory:")
+    random.seed(args.seed)
+
+    import logging
+    logging.disable(logging.INFO)
+    result = asyncio.run(run(args))
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    width = max(len(k) for k in result)
+    for k, v in result.items():
+        print(f"{k:<{width}}  {v:.4f}" if isinstance(v, float) else f"{k:<{width}}  {v}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,4 +1,6 @@
 import os
+import hashlib
+import time
 from typing import Set, Tuple, Optional
 
 # ===== Ключі та налаштування =====
@@ -9,10 +11,81 @@ PORT = int(os.getenv("PORT", "8443"))
 
 # ==== Константи пам'яті/міток ====
 MAX_TURNS = 10
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))  # токени на історію + поточне повідомлення (без системного промпту)
 ORDER_DUP_WINDOW_SEC = 20 * 60  # 20 хвилин
 ORDER_COOLDOWN_SEC = 3 * 60     # 3 хвилини
 ORDER_EDIT_WINDOW_SEC = 3 * 60 * 60  # 3 години — вікно, в якому замовлення можна редагувати
 
+# ==== Персистентність стану чатів ====
+CHAT_DB_PATH = os.getenv("CHAT_DB_PATH", "chat_state.sqlite3")
+PERSISTENCE_FLUSH_SEC = float(os.getenv("PERSISTENCE_FLUSH_SEC", "10"))
+CHAT_IDLE_EVICT_SEC = float(os.getenv("CHAT_IDLE_EVICT_SEC", str(30 * 60)))   # 30 хв без повідомлень → на диск
+MAX_RESIDENT_CHATS = int(os.getenv("MAX_RESIDENT_CHATS", "2000"))
+CHAT_EVICT_INTERVAL_SEC = float(os.getenv("CHAT_EVICT_INTERVAL_SEC", "60"))
+CHAT_DISK_RETENTION_DAYS = float(os.getenv("CHAT_DISK_RETENTION_DAYS", "0"))  # 0 — зберігати на диску безстроково
+ORDER_DB_PATH = os.getenv("ORDER_DB_PATH", "orders.sqlite3")  # журнал усіх замовлень (перевірка дублів, історія)
+
+# ==== Паралельність ====
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))  # апдейти різних чатів обробляються паралельно
+OPENAI_MAX_INFLIGHT = int(os.getenv("OPENAI_MAX_INFLIGHT", "8"))  # одночасних запитів до OpenAI
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "16"))       # keep-alive з'єднань до OpenAI (з запасом під хеджування)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))     # повтори на 429/5xx/таймаут
+OPENAI_RETRY_BASE_SEC = float(os.getenv("OPENAI_RETRY_BASE_SEC", "0.5"))
+OPENAI_HEDGE_ENABLED = os.getenv("OPENAI_HEDGE_ENABLED", "0") in ("1", "true", "True")  # дубль запиту, якщо довше за p95
+# Маршрутизація моделей: швидка мала модель для витягу/JSON, велика — для діалогу та ескалації,
+# коли результат малої моделі не проходить tools.try_parse_order_json. Follow-up — текст клієнту,
+# тож за замовчуванням та сама модель, що й основний діалог.
+OPENAI_ESCALATION_MODEL = os.getenv("OPENAI_MODEL_LARGE", "gpt-4o")
+_OPENAI_SMALL_MODEL = os.getenv("OPENAI_MODEL_SMALL", "gpt-4o-mini")
+OPENAI_MODELS = {
+    "main": os.getenv("OPENAI_MODEL_MAIN", OPENAI_ESCALATION_MODEL),
+    "followup": os.getenv("OPENAI_MODEL_FOLLOWUP", os.getenv("OPENAI_MODEL_MAIN", OPENAI_ESCALATION_MODEL)),
+    "force_point4": os.getenv("OPENAI_MODEL_FORCE_POINT4", _OPENAI_SMALL_MODEL),
+    "manager_parser": os.getenv("OPENAI_MODEL_MANAGER", _OPENAI_SMALL_MODEL),
+}
+OPENAI_TIMEOUTS = {  # секунди на один запит, за типом виклику
+    "main": float(os.getenv("OPENAI_TIMEOUT_MAIN", "25")),
+    "followup": float(os.getenv("OPENAI_TIMEOUT_FOLLOWUP", "12")),
+    "force_point4": float(os.getenv("OPENAI_TIMEOUT_FORCE_POINT4", "15")),
+    "manager_parser": float(os.getenv("OPENAI_TIMEOUT_MANAGER", "20")),
+}
+COALESCE_WINDOW_SEC = float(os.getenv("COALESCE_WINDOW_SEC", "1.5"))   # пауза, після якої серія повідомлень клієнта вважається завершеною; 0 — вимкнено
+COALESCE_MAX_WAIT_SEC = float(os.getenv("COALESCE_MAX_WAIT_SEC", "6"))  # максимальна затримка першого повідомлення серії
+
+# ==== Стрімінг відповідей ====
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1") not in ("0", "false", "False")
+STREAM_FIRST_CHUNK_CHARS = int(os.getenv("STREAM_FIRST_CHUNK_CHARS", "40"))     # скільки символів накопичити до першого повідомлення
+STREAM_EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", "1.0"))  # не частіше, ніж раз на N секунд редагуємо повідомлення
+
+# ==== Локальний роутер намірів ====
+LOCAL_ROUTER_ENABLED = os.getenv("LOCAL_ROUTER_ENABLED", "1") not in ("0", "false", "False")
+LOCAL_ROUTER_MIN_CONFIDENCE = float(os.getenv("LOCAL_ROUTER_MIN_CONFIDENCE", "0.8"))
+LOCAL_MANAGER_PARSER_ENABLED = os.getenv("LOCAL_MANAGER_PARSER_ENABLED", "1") not in ("0", "false", "False")  # замовлення менеджера за шаблоном — без GPT
+
+# ==== Пакетний імпорт замовлень менеджера ====
+BULK_PARSE_CONCURRENCY = int(os.getenv("BULK_PARSE_CONCURRENCY", "4"))  # одночасних розборів (запитів до GPT)
+BULK_MAX_RECORDS = int(os.getenv("BULK_MAX_RECORDS", "100"))            # замовлень в одному повідомленні/файлі
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES", str(512 * 1024)))
+
+# ==== Відправка в Telegram ====
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))              # повідомлень/с на весь бот (ліміт Telegram ~30)
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))                   # повідомлень/с в один приватний чат
+SEND_GROUP_RATE_PER_MIN = float(os.getenv("SEND_GROUP_RATE_PER_MIN", "20"))  # повідомлень/хв в одну групу
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", ORDER_DB_PATH)  # недоставлені пересилання замовлень
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))  # воркери для некритичних фонових завдань
+
+# ==== Кеш відповідей на типові запитання ====
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "500"))  # 0 — вимкнено
+RESPONSE_CACHE_TTL_SEC = float(os.getenv("RESPONSE_CACHE_TTL_SEC", "1800"))
+
+# ==== Інвентар (прайси/наявність) ====
+INVENTORY_PATH = os.getenv("INVENTORY_PATH", "inventory.json")  # якщо файлу немає — діють значення нижче
+INVENTORY_POLL_SEC = float(os.getenv("INVENTORY_POLL_SEC", "5"))  # як часто перевіряти зміну файлу; 0 — лише /reload
+
+# ==== Метрики ====
+METRICS_PORT = int(os.getenv("METRICS_PORT", str(PORT + 1)))  # окремий порт для /metrics; 0 — вимкнено
+
 # ==== ГРУПА ДЛЯ ЗАМОВЛЕНЬ ====
 ORDER_FORWARD_CHAT_ID = int(os.getenv("ORDER_FORWARD_CHAT_ID", "-1003062477534"))
 
@@ -118,6 +191,22 @@ def get_availability(country_norm: str) -> Tuple[str, Optional[str]]:
     if not entry: return ("+", None)
     return (entry.get("status", "+"), entry.get("reason", "").strip() or None)
 
+_INVENTORY_VERSION_TTL_SEC = 1.0
+_inventory_version_memo: Tuple[float, str] = (float("-inf"), "")
+
+def inventory_version(force: bool = False) -> str:
+    """Короткий хеш PRICE_TIERS + COUNTRY_AVAILABILITY. Змінюється лише тоді, коли реально змінився інвентар.
+    Хеш перераховується не частіше раза на секунду — його перевіряють кеші на кожному повідомленні."""
+    global _inventory_version_memo
+    now = time.monotonic()
+    if not force and now - _inventory_version_memo[0] < _INVENTORY_VERSION_TTL_SEC:
+        return _inventory_version_memo[1]
+    avail = sorted((k, v.get("status", "+"), v.get("reason", "")) for k, v in COUNTRY_AVAILABILITY.items())
+    raw = repr((list(PRICE_TIERS.items()), avail))
+    version = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+    _inventory_version_memo = (now, version)
+    return version
+
 # ==== КОДИ ДЛЯ АВТО-ВІДПОВІДІ ПІСЛЯ ЗАМОВЛЕННЯ ====
 POST_ORDER_USSD = {
     "ВЕЛИКОБРИТАНІЯ": "*#100#",
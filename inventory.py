@@ -0,0 +1,241 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, replace
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import config
+import tools
+import ai
+
+logger = logging.getLogger(__name__)
+
+# ==== Інвентар, що перезавантажується без рестарту ====
+# Прайси, наявність і USSD-коди можна винести в JSON-файл (config.INVENTORY_PATH):
+#   {"price_tiers": {"ПОЛЬЩА": [[10, 400], [4, 450], [1, 500]]},
+#    "availability": {"ІСПАНІЯ": {"status": "-", "reason": "Очікуються."}},
+#    "ussd_data": {"ЧЕХІЯ": [["T-mobile", "*101#"]]},
+#    "post_order_ussd": {"ІСПАНІЯ": "*321#"},
+#    "display": {...}, "flags": {...}}
+# Файл накладається поверх значень config.py по країнах: вказуємо лише те, що відрізняється
+# (прибрати країну з продажу — "status": "-").
+# Файл перевіряється раз на INVENTORY_POLL_SEC (за mtime). Новий знімок спершу повністю
+# парситься й валідовується, а потім підміняє дані одним синхронним кроком: tools/ai імпортують
+# словники config за іменем, тож вміст оновлюється на місці, без await посередині — жоден
+# хендлер не побачить наполовину застосований інвентар.
+
+@dataclass(frozen=True)
+class InventorySnapshot:
+    price_tiers: Mapping[str, Tuple[Tuple[int, Optional[int]], ...]]
+    availability: Mapping[str, Mapping[str, str]]
+    ussd_data: Mapping[str, Tuple[Tuple[Optional[str], str], ...]]
+    post_order_ussd: Mapping[str, str]
+    display: Mapping[str, str]
+    flags: Mapping[str, str]
+    source: str  # шлях до файлу або "config.py"
+
+class InventoryError(ValueError):
+    """Файл інвентарю некоректний — застосування скасовано, працюємо на попередньому знімку."""
+
+def _key(k: Any) -> str:
+    return str(k).strip().upper()
+
+def _parse_tiers(raw: Dict) -> Dict[str, Tuple[Tuple[int, Optional[int]], ...]]:
+    out = {}
+    for country, tiers in raw.items():
+        parsed = []
+        for t in tiers:
+            if not isinstance(t, (list, tuple)) or len(t) != 2:
+                raise InventoryError(f"price_tiers[{country}]: очікується [мін_кількість, ціна], отримано {t!r}")
+            min_q, price = t
+            if not isinstance(min_q, int) or min_q < 1 or (price is not None and not isinstance(price, int)):
+                raise InventoryError(f"price_tiers[{country}]: некоректний рівень {t!r}")
+            parsed.append((min_q, price))
+        if not parsed: raise InventoryError(f"price_tiers[{country}]: порожній список цін")
+        out[_key(country)] = tuple(sorted(parsed, key=lambda x: -x[0]))  # як у config.py: від більшої кількості
+    return out
+
+def _parse_availability(raw: Dict) -> Dict[str, Dict[str, str]]:
+    out = {}
+    for country, entry in raw.items():
+        if not isinstance(entry, dict): raise InventoryError(f"availability[{country}]: очікується об'єкт")
+        status = str(entry.get("status", "+")).strip()
+        if status not in ("+", "-"): raise InventoryError(f"availability[{country}]: status має бути '+' або '-'")
+        out[_key(country)] = {"status": status, "reason": str(entry.get("reason", "") or "")}
+    return out
+
+def _parse_ussd(raw: Dict) -> Dict[str, Tuple[Tuple[Optional[str], str], ...]]:
+    out = {}
+    for country, pairs in raw.items():
+        try: out[_key(country)] = tuple((op, str(code)) for op, code in pairs)
+        except (TypeError, ValueError): raise InventoryError(f"ussd_data[{country}]: очікується [[оператор, код], ...]")
+    return out
+
+def _str_map(raw: Dict) -> Dict[str, str]:
+    return {_key(k): str(v) for k, v in raw.items()}
+
+def _freeze(d: Dict) -> Mapping:
+    return MappingProxyType(dict(d))
+
+def snapshot_from_config() -> InventorySnapshot:
+    """Знімок поточних даних config (вбудовані значення або останній застосований інвентар)."""
+    return InventorySnapshot(
+        price_tiers=_freeze({k: tuple(v) for k, v in config.PRICE_TIERS.items()}),
+        availability=_freeze({k: MappingProxyType(dict(v)) for k, v in config.COUNTRY_AVAILABILITY.items()}),
+        ussd_data=_freeze({k: tuple(v) for k, v in config.USSD_DATA.items()}),
+        post_order_ussd=_freeze(config.POST_ORDER_USSD),
+        display=_freeze(config.DISPLAY),
+        flags=_freeze(config.FLAGS),
+        source="config.py",
+    )
+
+def parse_inventory(data: Dict, base: InventorySnapshot, source: str) -> InventorySnapshot:
+    if not isinstance(data, dict): raise InventoryError("очікується JSON-об'єкт")
+    def section(name: str, parser, current: Mapping) -> Mapping:
+        raw = data.get(name)
+        if raw is None: return current
+        if not isinstance(raw, dict): raise InventoryError(f"{name}: очікується об'єкт")
+        return _freeze({**current, **parser(raw)})
+    snap = InventorySnapshot(
+        price_tiers=section("price_tiers", _parse_tiers, base.price_tiers),
+        availability=section("availability", _parse_availability, base.availability),
+        ussd_data=section("ussd_data", _parse_ussd, base.ussd_data),
+        post_order_ussd=section("post_order_ussd", _str_map, base.post_order_ussd),
+        display=section("display", _str_map, base.display),
+        flags=section("flags", _str_map, base.flags),
+        source=source,
+    )
+    missing = [k for k in snap.price_tiers if k not in snap.display]
+    if missing: raise InventoryError(f"немає назви (display) для: {', '.join(missing)}")
+    return snap
+
+def _replace(target: Dict, items: Dict) -> None:
+    target.clear()
+    target.update(items)
+
+def apply_snapshot(snap: InventorySnapshot) -> None:
+    """Підміняє дані в config одним синхронним кроком і скидає залежні кеші."""
+    global _current
+    _replace(config.PRICE_TIERS, {k: list(v) for k, v in snap.price_tiers.items()})
+    _replace(config.COUNTRY_AVAILABILITY, {k: dict(v) for k, v in snap.availability.items()})
+    _replace(config.USSD_DATA, {k: list(v) for k, v in snap.ussd_data.items()})
+    _replace(config.POST_ORDER_USSD, dict(snap.post_order_ussd))
+    _replace(config.DISPLAY, dict(snap.display))
+    _replace(config.FLAGS, dict(snap.flags))
+    _current = snap
+    _invalidate_caches()
+    logger.info(f"Inventory applied from {snap.source} (version {config.inventory_version()})")
+
+def _invalidate_caches() -> None:
+    tools.normalize_country.cache_clear()
+    tools.invalidate_price_snapshot()  # також перераховує config.inventory_version
+    ai.invalidate_prompt_cache()       # разом із кешем відповідей
+
+# Базовий знімок — вбудовані значення config.py
+_builtin: InventorySnapshot = snapshot_from_config()
+_current: InventorySnapshot = _builtin
+_loaded_mtime: Optional[float] = None
+_watch_task: Optional[asyncio.Task] = None
+
+def current() -> InventorySnapshot:
+    return _current
+
+def load_file(path: Optional[str] = None) -> bool:
+    """Читає й застосовує файл інвентарю. False — файлу немає або він некоректний (лишається попередній знімок)."""
+    global _loaded_mtime
+    path = path or config.INVENTORY_PATH
+    try: mtime = os.path.getmtime(path)
+    except OSError: return False
+    try:
+        with open(path, encoding="utf-8") as f:
+            snap = parse_inventory(json.load(f), _builtin, path)
+    except (OSError, json.JSONDecodeError, InventoryError) as e:
+        logger.error(f"Inventory file {path} rejected: {e}")
+        _loaded_mtime = mtime  # той самий битий файл повторно не перечитуємо
+        return False
+    apply_snapshot(snap)
+    _loaded_mtime = mtime
+    return True
+
+def reload_if_changed(path: Optional[str] = None) -> bool:
+    path = path or config.INVENTORY_PATH
+    try: mtime = os.path.getmtime(path)
+    except OSError: return False
+    if mtime == _loaded_mtime: return False
+    return load_file(path)
+
+async def _watch_loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try: reload_if_changed()
+        except Exception as e: logger.error(f"Inventory watch error: {e}")
+
+def start_watch(interval: float) -> None:
+    global _watch_task
+    if _watch_task is None and interval > 0:
+        _watch_task = asyncio.create_task(_watch_loop(interval))
+
+def stop_watch() -> None:
+    global _watch_task
+    if _watch_task is not None:
+        _watch_task.cancel()
+        _watch_task = None
+
+def summary() -> str:
+    """Короткий звіт для менеджера: джерело, версія і що зараз немає в наявності."""
+    snap = current()
+    out_of_stock = [snap.display.get(k, k) for k in snap.price_tiers if snap.availability.get(k, {}).get("status", "+") == "-"]
+    lines = [f"Інвентар: {snap.source}, версія {config.inventory_version()}",
+             f"Країн у прайсі: {len(snap.price_tiers)}"]
+    lines.append("Немає в наявності: " + (", ".join(out_of_stock) if out_of_stock else "—"))
+    return "\n".join(lines)
+
+# ==== Точкові зміни (команди менеджера /stock, /price) ====
+# Міняється один запис у config і в знімку; решта інвентарю не копіюється й не перевіряється.
+def set_availability(country: str, status: str, reason: str = "") -> None:
+    global _current
+    if country not in config.PRICE_TIERS: raise InventoryError(f"країни {country} немає в прайсі")
+    if status not in ("+", "-"): raise InventoryError("статус має бути '+' або '-'")
+    entry = {"status": status, "reason": reason}
+    config.COUNTRY_AVAILABILITY[country] = entry
+    _current = replace(_current, availability=MappingProxyType({**_current.availability, country: MappingProxyType(dict(entry))}))
+    _invalidate_caches()
+    logger.info(f"Availability {country} -> {status} {reason}".rstrip())
+
+def set_price_tiers(country: str, changes: Dict[int, Optional[int]]) -> List[Tuple[int, Optional[int]]]:
+    """changes: мін. кількість -> нова ціна (None — прибрати рівень). Повертає нові рівні."""
+    global _current
+    if country not in config.DISPLAY: raise InventoryError(f"невідома країна {country}")
+    tiers = dict(config.PRICE_TIERS.get(country, []))
+    for min_q, price in changes.items():
+        if min_q < 1 or (price is not None and price < 0): raise InventoryError(f"некоректний рівень {min_q}:{price}")
+        if price is None: tiers.pop(min_q, None)
+        else: tiers[min_q] = price
+    if not tiers: raise InventoryError("після змін не лишилось жодної ціни")
+    new_tiers = sorted(tiers.items(), key=lambda x: -x[0])
+    config.PRICE_TIERS[country] = new_tiers
+    _current = replace(_current, price_tiers=MappingProxyType({**_current.price_tiers, country: tuple(new_tiers)}))
+    _invalidate_caches()
+    logger.info(f"Price tiers {country} -> {new_tiers}")
+    return new_tiers
+
+def save(path: Optional[str] = None) -> None:
+    """Зберігає поточні прайси й наявність у файл інвентарю (атомарно, через тимчасовий файл).
+    Інші секції файлу, якщо вони є, лишаються без змін."""
+    global _loaded_mtime
+    path = path or config.INVENTORY_PATH
+    data: Dict[str, Any] = {}
+    try:
+        with open(path, encoding="utf-8") as f: data = json.load(f)
+        if not isinstance(data, dict): data = {}
+    except (OSError, json.JSONDecodeError): pass
+    snap = current()
+    data["price_tiers"] = {k: [list(t) for t in v] for k, v in snap.price_tiers.items()}
+    data["availability"] = {k: dict(v) for k, v in snap.availability.items()}
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    _loaded_mtime = os.path.getmtime(path)  # власний запис не перечитуємо
@@ -1,13 +1,23 @@
 import time
+import asyncio
+import dataclasses
+import functools
 import logging
 import re
-from telegram import Update
+from typing import List, Optional, Tuple
+from telegram import Message, Update
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # Імпорти з наших нових файлів
 import config
 import tools
 import ai
+import storage
+import scheduler
+import metrics
+import inventory
+import outbound
 
 # Налаштування логів
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -22,8 +32,240 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await msg.reply_text("Вітаю! Я допоможу вам оформити замовлення на SIM-карти, а також постараюсь надати відповіді на всі ваші запитання.")
 
+def is_manager_user(user) -> bool:
+    if not user: return False
+    if config.MANAGER_USER_IDS and user.id in config.MANAGER_USER_IDS:
+        return True
+    if config.MANAGER_USERNAMES and user.username and user.username.lower() in config.MANAGER_USERNAMES:
+        return True
+    return False
+
+def is_order_group_owner(msg) -> bool:
+    """Власник пише в групі замовлень — йому доступні службові команди."""
+    return bool(msg and msg.chat and msg.chat.id == config.ORDER_FORWARD_CHAT_ID and
+                msg.from_user and msg.from_user.username and
+                msg.from_user.username.lower() == (config.DEFAULT_OWNER_USERNAME or "").strip().lstrip("@").lower())
+
+def is_customer_message(update: Update) -> bool:
+    """Повідомлення клієнта в бізнес-чаті (не група замовлень і не менеджер) — їх можна склеювати."""
+    msg = update.effective_message
+    if not msg or msg.chat.id == config.ORDER_FORWARD_CHAT_ID: return False
+    if msg.chat.type == "private" and not getattr(msg, "business_connection_id", None): return False
+    return not is_manager_user(msg.from_user)
+
+coalescer = scheduler.MessageCoalescer(window=config.COALESCE_WINDOW_SEC, max_wait=config.COALESCE_MAX_WAIT_SEC)
+
+ledger = storage.OrderLedger(config.ORDER_DB_PATH)
+
+SERVICE_BUSY_REPLY = "Вибачте, зараз відповідь затримується з технічних причин. Спробуйте, будь ласка, написати ще раз за хвилину 🙏"
+
+# Фонові завдання — лише те, втрата чого нешкідлива (напр. видалення вихідного повідомлення менеджера)
+background = scheduler.BackgroundWorker(workers=config.BACKGROUND_WORKERS)
+
+async def record_order(order: tools.OrderData, chat_id: int, username: Optional[str], source: str) -> None:
+    """Запис замовлення в журнал — до відповіді клієнту: журнал є і історією, і захистом від дублів,
+    тож наступне повідомлення має вже бачити цей рядок. Локальний запис у SQLite — мілісекунди."""
+    await asyncio.to_thread(
+        ledger.record, chat_id=chat_id, username=username, source=source, edited=order.edited,
+        full_name=order.full_name, phone=order.phone, city=order.city, np=order.np,
+        order_sig=tools.order_signature(order), items_sig=tools.items_signature(order),
+        total=tools.calc_order_total(order), data=dataclasses.asdict(order),
+    )
+
+def delete_in_background(context, chat_id: int, message_id: int) -> None:
+    """Видалення у фоні: якщо не вдасться, в групі лишиться зайве повідомлення — не більше."""
+    async def run():
+        try: await outbound.delete_message(context.bot, chat_id, message_id)
+        except (BadRequest, Forbidden) as e: logger.warning(f"Del msg error: {e}")
+    background.submit("delete_message", run)
+
+async def forward_to_group(context, text: str) -> None:
+    """Пересилання в групу замовлень. Рядок outbox пишеться тут, до виходу з хендлера, — сама відправка
+    йде у фоні через send_queue; якщо Telegram не прийняв повідомлення або бот перезапустився, воно буде дослане."""
+    await outbound.send_durable(context.bot, config.ORDER_FORWARD_CHAT_ID, text)
+
+# ===== Стрімінг відповіді GPT =====
+async def stream_main_reply(msg, history, user_payload) -> Tuple[str, Optional[Message]]:
+    """Показує відповідь GPT клієнту в міру генерації (перше повідомлення + редагування).
+    Керуючі JSON-відповіді (замовлення/ціни/USSD/крипто) не показуються — лише буферизуються.
+    Повертає повний текст відповіді та надіслане повідомлення (якщо щось було показано)."""
+    buf, shown, sent = "", "", None
+    control, last_edit = False, 0.0
+    try:
+        async for delta in ai.stream_gpt_main(history, user_payload):
+            buf += delta
+            if control: continue
+            head = buf.strip()
+            if head[:1] in ("{", "`") or head.startswith("🛒") or "{" in head:
+                control = True  # схоже на JSON (або шаблон, який бекенд може замінити) — далі лише буфер
+                continue
+            now = time.monotonic()
+            if sent is None:
+                if len(head) >= config.STREAM_FIRST_CHUNK_CHARS:
+                    sent = await outbound.send_queue.submit(msg.chat.id, functools.partial(msg.reply_text, head))
+                    shown, last_edit = head, now
+            elif head != shown and now - last_edit >= config.STREAM_EDIT_INTERVAL_SEC:
+                try:
+                    edited = await outbound.send_queue.submit(msg.chat.id, functools.partial(sent.edit_text, head))
+                    if isinstance(edited, Message): sent = edited  # sent.text завжди = показаний текст
+                    shown = head
+                except Exception as e: logger.warning(f"Stream edit error: {e}")
+                last_edit = now
+    except ai.GPTStreamInterrupted:
+        # Обірваний текст не можна лишати як відповідь: прибираємо показане, далі — як при недоступності GPT
+        if sent is not None:
+            try: await outbound.send_queue.submit(msg.chat.id, sent.delete)
+            except Exception as e: logger.warning(f"Stream delete error: {e}")
+        raise
+    return buf, sent
+
+# ===== /reload (група замовлень) =====
+async def reload_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    if not is_order_group_owner(msg): return
+    if inventory.load_file():
+        await msg.reply_text("✅ Інвентар перезавантажено.\n" + inventory.summary())
+    else:
+        await msg.reply_text(f"⚠️ Не вдалося завантажити {config.INVENTORY_PATH} — діє попередній інвентар.\n" + inventory.summary())
+
+# ===== /stock, /price (група замовлень) =====
+async def _save_inventory(msg) -> None:
+    try: await asyncio.to_thread(inventory.save)
+    except OSError as e:
+        logger.error(f"Inventory save error: {e}")
+        await msg.reply_text(f"⚠️ Зміну застосовано, але не збережено у {config.INVENTORY_PATH}: {e}")
+
+async def stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    if not is_order_group_owner(msg): return
+    parsed = tools.parse_stock_command(context.args or [])
+    if not parsed:
+        await msg.reply_text("Формат: /stock ІСПАНІЯ +  або  /stock ІСПАНІЯ - причина")
+        return
+    country, status, reason = parsed
+    try: inventory.set_availability(country, status, reason)
+    except inventory.InventoryError as e:
+        await msg.reply_text(f"⚠️ {e}")
+        return
+    await _save_inventory(msg)
+    await msg.reply_text(f"✅ Наявність оновлено.\n\n{tools.render_price_block(country).strip()}")
+
+async def price_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    if not is_order_group_owner(msg): return
+    parsed = tools.parse_price_command(context.args or [])
+    if not parsed:
+        await msg.reply_text("Формат: /price ПОЛЬЩА 10:380 4:450  (мін. кількість:ціна; 1:- — прибрати рівень)")
+        return
+    country, changes = parsed
+    try: inventory.set_price_tiers(country, changes)
+    except inventory.InventoryError as e:
+        await msg.reply_text(f"⚠️ {e}")
+        return
+    await _save_inventory(msg)
+    await msg.reply_text(f"✅ Ціни оновлено.\n\n{tools.render_price_block(country).strip()}")
+
+# ===== Замовлення менеджера (група замовлень) =====
+BULK_SEPARATOR = "\n\n➖➖➖\n\n"
+
+def _split_note(text: str) -> Tuple[str, Optional[str]]:
+    parts = re.split(r'\bпримітка[:\s]*', text, maxsplit=1, flags=re.IGNORECASE)
+    return (parts[0], parts[1].strip()) if len(parts) > 1 else (text, None)
+
+async def parse_manager_order(text: str) -> Tuple[Optional[tools.OrderData], bool]:
+    """Шаблонні замовлення розбираються правилами, решта — через GPT. Повертає (замовлення, розібрано локально).
+    При недоступності OpenAI кидає ai.GPTCallFailed."""
+    if config.LOCAL_MANAGER_PARSER_ENABLED:
+        with metrics.span("manager_local"):
+            local = tools.parse_manager_order_local(text)
+        if local and local.complete:
+            logger.info("Manager order parsed locally — GPT skipped")
+            return local.order, True
+        if local: logger.info(f"Manager order: local parse incomplete (score {local.score}, ambiguous={local.ambiguous}) — GPT")
+    with metrics.span("manager_gpt"):
+        json_resp = await ai.ask_gpt_to_parse_manager_order(text)
+    return tools.try_parse_manager_order_json(json_resp), False
+
+def render_manager_order(order: tools.OrderData, source_text: str, note: Optional[str]) -> str:
+    formatted = tools.render_order_for_group(order, paid=bool(tools.PAID_HINT_RE.search(source_text))).strip()
+    if note: formatted += f"\n\n⚠️ Примітка: {note}"
+    return formatted
+
+def _excerpt(record: str, limit: int = 50) -> str:
+    line = record.strip().splitlines()[0] if record.strip() else ""
+    return line if len(line) <= limit else line[:limit - 1] + "…"
+
+async def import_manager_orders(msg, context, records: List[str]) -> None:
+    """Пакетний імпорт: записи розбираються паралельно (не більше BULK_PARSE_CONCURRENCY одночасно),
+    готові замовлення йдуть у групу мінімумом повідомлень, по нерозібраних — звіт із номерами записів."""
+    if len(records) > config.BULK_MAX_RECORDS:
+        await outbound.reply(msg, f"⚠️ Забагато замовлень за раз: {len(records)} (максимум {config.BULK_MAX_RECORDS}).")
+        return
+    sem = asyncio.Semaphore(config.BULK_PARSE_CONCURRENCY)
+
+    async def parse_one(record: str) -> Tuple[Optional[tools.OrderData], str]:
+        text, note = _split_note(record)
+        async with sem:
+            try: order, _ = await parse_manager_order(text)
+            except ai.GPTCallFailed: return None, "OpenAI не відповідає"
+        if not order or not order.items: return None, "не вдалося розібрати"
+        return order, render_manager_order(order, record, note)
+
+    results = await asyncio.gather(*(parse_one(r) for r in records))
+    formatted, errors, warnings = [], [], []
+    for i, (record, (order, text)) in enumerate(zip(records, results), 1):
+        if order is None:
+            errors.append(f"{i}. {_excerpt(record)} — {text}")
+            continue
+        if len(tools.phones_in(record)) > 1:
+            warnings.append(f"{i}. {_excerpt(record)} — кілька телефонів, розібрано одне замовлення")
+        formatted.append(text)
+        await record_order(order, msg.chat.id, msg.from_user.username, "manager_bulk")
+    logger.info(f"Bulk import: {len(formatted)}/{len(records)} orders parsed")
+
+    # Через outbox: повідомлення менеджера видаляється, тож замовлення не мають загубитись
+    for text in outbound.pack_texts(formatted, BULK_SEPARATOR):
+        await outbound.send_durable(context.bot, msg.chat.id, text)
+    if not errors and not warnings:
+        delete_in_background(context, msg.chat.id, msg.message_id)
+        return
+    # Оригінал лишається — нерозібрані записи можна виправити й надіслати повторно
+    report = [f"⚠️ Імпортовано {len(formatted)} з {len(records)}."]
+    if errors: report += ["Не розібрано:"] + errors
+    if warnings: report += ["Перевірте:"] + warnings
+    for text in outbound.pack_texts(report, "\n"):
+        await outbound.reply(msg, text)
+
+def _decode_upload(raw: bytes) -> str:
+    for encoding in ("utf-8-sig", "cp1251"):
+        try: return raw.decode(encoding)
+        except UnicodeDecodeError: continue
+    return raw.decode("utf-8", errors="replace")
+
+async def import_orders_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Файл .txt/.csv із замовленнями в групі замовлень (CSV: рядок = замовлення)."""
+    msg = update.effective_message
+    if not is_order_group_owner(msg) or not msg.document: return
+    doc = msg.document
+    if doc.file_size and doc.file_size > config.BULK_MAX_FILE_BYTES:
+        await outbound.reply(msg, f"⚠️ Файл завеликий (максимум {config.BULK_MAX_FILE_BYTES // 1024} КБ).")
+        return
+    tg_file = await doc.get_file()
+    content = _decode_upload(bytes(await tg_file.download_as_bytearray()))
+    name = (doc.file_name or "").lower()
+    records = tools.bulk_records_from_csv(content) if name.endswith(".csv") else tools.split_bulk_orders(content)
+    if not records:
+        await outbound.reply(msg, "⚠️ У файлі не знайдено замовлень.")
+        return
+    await import_manager_orders(msg, context, records)
+
 # ===== Менеджер повідомлень (Головна логіка) =====
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@scheduler.coalesce_messages(coalescer, is_customer_message, quote_of=tools.extract_quoted_text)
+@scheduler.per_chat_serialized
+@metrics.traced
+@outbound.batched
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: Optional[str] = None,
+                         quotes: Optional[List[str]] = None):
     msg = update.effective_message
     if not msg: return
     
@@ -31,7 +273,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if msg.chat.type == "private" and not getattr(msg, "business_connection_id", None):
         return
     
-    raw_user_message = msg.text.strip() if msg.text else ""
+    # text — склеєна серія повідомлень клієнта, quotes — цитати всіх її повідомлень (див. scheduler.coalesce_messages)
+    raw_user_message = text if text is not None else (msg.text.strip() if msg.text else "")
     if not raw_user_message: return  # Ігноруємо порожні/нетекстові повідомлення
     
     # --- Ініціалізація історії ---
@@ -43,9 +286,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         del history[:len(history) - max_entries]
 
     # --- 1. Обробка команд МЕНЕДЖЕРА в групі замовлень ---
-    if (msg.chat and msg.chat.id == config.ORDER_FORWARD_CHAT_ID and 
-        msg.from_user and msg.from_user.username and 
-        msg.from_user.username.lower() == (config.DEFAULT_OWNER_USERNAME or "").strip().lstrip("@").lower()):
+    if is_order_group_owner(msg):
         
         # === Ігноруємо розділювачі (..., ---, пробіли, …) ===
         if re.match(r'^[\.\-\s…]+$', raw_user_message):
@@ -74,42 +315,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 note = note_match.group(1).strip()
                 if note: final_text = orig_text.strip() + f"\n\n⚠️ Примітка: {note}"
 
+            if final_text and BULK_SEPARATOR.strip() in orig_text:
+                # Пакет із кількох замовлень: правка зачепила б усі, а видалення прибрало б їх з групи
+                metrics.mark_branch("manager_edit_refused")
+                await outbound.reply(msg, "⚠️ Це повідомлення містить кілька замовлень — правку не застосовано. "
+                                          "Надішліть потрібне замовлення окремим повідомленням і відповідайте на нього.")
+                return
             if final_text:
+                metrics.mark_branch("manager_edit")
                 try:
-                    await context.bot.delete_message(msg.chat.id, msg.reply_to_message.message_id)
-                    await context.bot.delete_message(msg.chat.id, msg.message_id)
+                    await outbound.delete_message(context.bot, msg.chat.id, msg.reply_to_message.message_id)
+                    await outbound.delete_message(context.bot, msg.chat.id, msg.message_id)
                 except Exception as e: logger.warning(f"Del msg error: {e}")
-                await context.bot.send_message(msg.chat.id, final_text)
+                await outbound.send_message(context.bot, msg.chat.id, final_text)
                 return
 
-        # Парсинг нового замовлення від менеджера через GPT
-        parts = re.split(r'\bпримітка[:\s]*', raw_user_message, maxsplit=1, flags=re.IGNORECASE)
-        text_for_gpt, note_text = (parts[0], parts[1].strip()) if len(parts) > 1 else (raw_user_message, None)
-        
-        json_resp = await ai.ask_gpt_to_parse_manager_order(text_for_gpt)
-        parsed = tools.try_parse_manager_order_json(json_resp)
+        # Кілька замовлень в одному повідомленні — пакетний імпорт
+        records = tools.split_bulk_orders(raw_user_message)
+        if len(records) > 1:
+            metrics.mark_branch("manager_bulk")
+            await import_manager_orders(msg, context, records)
+            return
+
+        # Парсинг нового замовлення від менеджера: шаблонні — правилами, решта — через GPT
+        text_for_gpt, note_text = _split_note(raw_user_message)
+        try:
+            parsed, local = await parse_manager_order(text_for_gpt)
+        except ai.GPTCallFailed:
+            metrics.mark_branch("service_busy")
+            await outbound.send_message(context.bot, msg.chat.id, "⚠️ Не вдалося розібрати замовлення (OpenAI не відповідає). Надішліть, будь ласка, ще раз.")
+            return
+        metrics.mark_branch("manager_order_local" if local else "manager_order")
         if parsed:
-            try: await context.bot.delete_message(msg.chat.id, msg.message_id)
-            except: pass
-            formatted = tools.render_order_for_group(parsed, paid=bool(tools.PAID_HINT_RE.search(raw_user_message))).strip()
-            if note_text: formatted += f"\n\n⚠️ Примітка: {note_text}"
-            await context.bot.send_message(msg.chat.id, formatted)
+            # Кілька телефонів — можливо, це кілька замовлень, а розібрано одне: оригінал не видаляємо
+            several_phones = len(tools.phones_in(raw_user_message)) > 1
+            await record_order(parsed, msg.chat.id, msg.from_user.username, "manager")
+            await outbound.send_message(context.bot, msg.chat.id, render_manager_order(parsed, raw_user_message, note_text))
+            if not several_phones: delete_in_background(context, msg.chat.id, msg.message_id)
+            else:
+                await outbound.reply(msg, "⚠️ У повідомленні кілька телефонів, а розібрано одне замовлення — перевірте, оригінал залишено.")
         return
 
     # --- 2. Якщо пише Менеджер (ігноруємо в усіх інших чатах) ---
-    is_manager = False
-    if msg.from_user:
-        if config.MANAGER_USER_IDS and msg.from_user.id in config.MANAGER_USER_IDS:
-            is_manager = True
-        if config.MANAGER_USERNAMES and msg.from_user.username and msg.from_user.username.lower() in config.MANAGER_USERNAMES:
-            is_manager = True
-            
-    if is_manager:
+    if is_manager_user(msg.from_user):
         return
 
     # --- 3. Підготовка контексту для користувача ---
     user_payload = raw_user_message
-    quoted = tools.extract_quoted_text(msg)
+    if quotes is None: quotes = [q for q in [tools.extract_quoted_text(msg)] if q]
+    quoted = "\n\n".join(quotes)
     if quoted: user_payload += f"\n\n[ЦЕ ПРОЦИТОВАНЕ ПОВІДОМЛЕННЯ КЛІЄНТА:]\n{quoted}"
 
     # Підказки для пункту 4 (кількість/країни)
@@ -128,9 +382,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- 4. Force Point 4 (Спроба дозбирати замовлення) ---
     if context.chat_data.get("awaiting_missing") == {4}:
-        force_json = await ai.ask_gpt_force_point4(history, user_payload)
+        with metrics.span("point4_gpt"):
+            force_json = await ai.ask_gpt_force_point4(history, user_payload)
         forced = tools.try_parse_order_json(force_json)
         if forced and forced.items and all([forced.full_name, forced.phone, forced.city, forced.np]):
+            metrics.mark_branch("point4_order")
             valid_items, out_of_stock = [], {}
             for item in forced.items:
                 c_key = tools.normalize_country(item.country).upper()
@@ -139,7 +395,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if stat == "+": valid_items.append(item)
                 else: out_of_stock[c_key] = reas
             
-            if out_of_stock: await msg.reply_text(tools.render_out_of_stock(out_of_stock))
+            if out_of_stock: await outbound.reply(msg, tools.render_out_of_stock(out_of_stock))
             if not valid_items:
                 context.chat_data.pop("awaiting_missing", None)
                 context.chat_data.pop("point4_hint", None)
@@ -147,8 +403,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             forced.items = valid_items
             summary = tools.render_order(forced)
-            context.chat_data["last_order_sig"] = tools.order_signature(forced)
-            context.chat_data["last_order_time"] = time.time()
+            await record_order(forced, msg.chat.id, msg.from_user.username if msg.from_user else None, "client")
             context.chat_data["order_completed_at"] = time.time()  # <-- мітка завершення
             context.chat_data["last_order_total"] = tools.calc_order_total(forced)  # <-- сума для крипти
             context.chat_data.pop("awaiting_missing", None)
@@ -156,16 +411,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             history.append({"role": "user", "content": raw_user_message})
             history.append({"role": "assistant", "content": summary})
-            await msg.reply_text(summary)
-            await msg.reply_text("Дякуємо за замовлення, воно буде відправлено протягом 24 годин. 😊")
+            await outbound.reply(msg, summary)
+            await outbound.reply(msg, "Дякуємо за замовлення, воно буде відправлено протягом 24 годин. 😊")
             
             # === АВТО-ПОВІДОМЛЕННЯ З КОДАМИ ===
             post_order_text = tools.render_post_order_info(forced)
             if post_order_text:
-                await msg.reply_text(post_order_text)
+                await outbound.reply(msg, post_order_text)
 
-            try: await context.bot.send_message(config.ORDER_FORWARD_CHAT_ID, f"@{msg.from_user.username}\n{summary}" if msg.from_user.username else summary)
-            except Exception as e: logger.warning(f"Forward error: {e}")
+            await forward_to_group(context, f"@{msg.from_user.username}\n{summary}" if msg.from_user.username else summary)
             return
 
     # --- 4.5. Захист від дублювання замовлень ---
@@ -176,27 +430,60 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.chat_data.get("dup_clarify_pending"):
         context.chat_data.pop("dup_clarify_pending", None)
         if tools.is_new_order_confirm(raw_user_message):
-            # Клієнт підтвердив: це справді нове замовлення. Скидаємо сигнатуру,
-            # щоб наступний ідентичний JSON пройшов як нове замовлення.
-            context.chat_data.pop("last_order_sig", None)
+            # Клієнт підтвердив: це справді нове замовлення — наступний ідентичний JSON
+            # проходить без перевірки дублів.
+            context.chat_data["dup_override"] = True
             user_payload += "\n\n[СИСТЕМНЕ: клієнт підтвердив НОВЕ замовлення з тими самими даними. Згенеруй JSON замовлення повторно.]"
         # якщо не підтвердив — просто йдемо далі, GPT відповість як консультант
 
     # Рівень 1: Ack-повідомлення після щойно оформленого замовлення → не кличемо GPT
     if order_is_recent and tools.is_ack_message(raw_user_message):
         logger.info(f"Ack after order intercepted: '{raw_user_message}'")
+        metrics.mark_branch("ack")
         ack_reply = "Якщо у вас виникнуть додаткові питання — звертайтесь! 😊"
         history.append({"role": "user", "content": raw_user_message})
         history.append({"role": "assistant", "content": ack_reply})
-        await msg.reply_text(ack_reply)
+        await outbound.reply(msg, ack_reply)
         return
     
     # Рівень 2: Не ack, але замовлення нещодавно оформлене → підказка для GPT
     if order_is_recent:
         user_payload += "\n\n[СИСТЕМНЕ НАГАДУВАННЯ: замовлення щойно оформлене. НЕ генеруй повторний JSON, якщо клієнт просто підтверджує або ставить запитання. АЛЕ якщо клієнт хоче ЗМІНИТИ замовлення (іншу кількість, іншу країну тощо) — згенеруй новий JSON з \"edited\": true.]"
 
-    # --- 5. Основний запит до GPT ---
-    reply_text = await ai.ask_gpt_main(history, user_payload)
+    # --- 5. Основний запит до GPT (або локальний роутер для однозначних запитів) ---
+    local_intent = None
+    if config.LOCAL_ROUTER_ENABLED and not quoted:
+        local_intent = tools.route_intent(raw_user_message)
+        if local_intent and local_intent.confidence < config.LOCAL_ROUTER_MIN_CONFIDENCE:
+            local_intent = None
+        # Крипто-оплата без оформленого замовлення — найчастіше питання «а можна криптою?»: відповідає GPT
+        if local_intent and local_intent.kind == "crypto" and not context.chat_data.get("last_order_total"):
+            local_intent = None
+    # Кеш відповідей — лише для першого повідомлення в чаті і коли payload не містить контексту
+    # (цитати, підказки п.4, системні нагадування): ключ — тільки текст, тож відповідь, що спирається
+    # на історію («а 5 штук?», «так»), не можна віддавати іншому клієнту
+    cacheable = not history and user_payload == raw_user_message and not context.chat_data.get("awaiting_missing")
+    cached_reply = ai.response_cache.get(raw_user_message) if cacheable and not local_intent else None
+    streamed_msg = None
+    if local_intent:
+        logger.info(f"Local intent '{local_intent.kind}' ({local_intent.confidence}) — GPT skipped")
+        reply_text = local_intent.as_gpt_json()
+    elif cached_reply is not None:
+        logger.info("Response cache hit — GPT skipped")
+        reply_text = cached_reply
+    else:
+        try:
+            with metrics.span("main_gpt"):
+                if config.STREAMING_ENABLED:
+                    reply_text, streamed_msg = await stream_main_reply(msg, history, user_payload)
+                else:
+                    reply_text = await ai.ask_gpt_main(history, user_payload)
+        except ai.GPTCallFailed:
+            # Не мовчимо: клієнт бачить, що повідомлення отримане, і може повторити
+            metrics.mark_branch("service_busy")
+            await outbound.reply(msg, SERVICE_BUSY_REPLY)
+            return
+        if cacheable: ai.response_cache.put(raw_user_message, reply_text)
     
     # Виправлення "Залишилось вказати"
     if "Залишилось вказати:" in reply_text and "📝" not in reply_text:
@@ -204,11 +491,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if reply_text.strip().startswith("🛒 Для оформлення") and context.chat_data.get("awaiting_missing") == {1, 2, 3}:
         reply_text = "📝 Залишилось вказати:\n\n1. Ім'я та прізвище.\n2. Номер телефону.\n3. Місто та № відділення."
 
+    # Стрім виявився керуючим JSON уже після показу частини тексту — прибираємо показане
+    if streamed_msg and tools.has_json_block(reply_text):
+        try: await outbound.send_queue.submit(msg.chat.id, streamed_msg.delete)
+        except Exception as e: logger.warning(f"Stream delete error: {e}")
+        streamed_msg = None
+
     # --- 6. Обробка відповідей GPT (JSON або текст) ---
     
     # А) Сформоване замовлення
-    parsed = tools.try_parse_order_json(reply_text)
+    with metrics.span("parse"):
+        parsed = tools.try_parse_order_json(reply_text)
     if parsed and parsed.items and all([parsed.full_name, parsed.phone, parsed.city, parsed.np]):
+        metrics.mark_branch("order")
         valid_items, out_of_stock = [], {}
         for item in parsed.items:
             c_key = tools.normalize_country(item.country).upper()
@@ -218,9 +513,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else: out_of_stock[c_key] = reas
         
         if out_of_stock:
-            await msg.reply_text(tools.render_out_of_stock(out_of_stock))
-            if valid_items: await msg.reply_text("Чи відправити лише ті позиції, що є в наявності, або бажаєте зробити заміну?")
-            else: await msg.reply_text("Можливо, вас зацікавить якась інша країна з нашого асортименту?")
+            await outbound.reply(msg, tools.render_out_of_stock(out_of_stock))
+            if valid_items: await outbound.reply(msg, "Чи відправити лише ті позиції, що є в наявності, або бажаєте зробити заміну?")
+            else: await outbound.reply(msg, "Можливо, вас зацікавить якась інша країна з нашого асортименту?")
             return
 
         if not valid_items: return
@@ -234,46 +529,44 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.info("Edit window expired — treating as new order")
                 parsed.edited = False
 
-        # Перевірка дублікатів (Рівень 3) — пропускаємо для відредагованих замовлень
-        sig = tools.order_signature(parsed)
-        if not parsed.edited:
-            last_sig = context.chat_data.get("last_order_sig")
-            last_time = context.chat_data.get("last_order_time", 0)
-            time_since_last = time.time() - last_time
-            if last_sig:
-                # Точне співпадіння сигнатури — блокуємо протягом 20 хв
-                if sig == last_sig and time_since_last <= config.ORDER_DUP_WINDOW_SEC:
-                    logger.info("Duplicate order blocked (exact sig match)")
-                    context.chat_data.pop("awaiting_missing", None)
-                    return
-                # Нечітке (ті самі товари) — блокуємо лише протягом 3 хв,
-                # щоб не заблокувати те саме замовлення для іншої людини
-                if time_since_last <= config.ORDER_COOLDOWN_SEC:
-                    if tools.items_signature(parsed) == tools.items_signature_from_sig(last_sig):
-                        logger.info("Duplicate order blocked (same items within cooldown)")
-                        context.chat_data.pop("awaiting_missing", None)
-                        return
-                # ДОВГОСТРОКОВИЙ захист: якщо ПІБ+телефон+товари ІДЕНТИЧНІ останньому
-                # замовленню — це майже напевно помилкове дублювання (GPT повторив
-                # замовлення з історії у відповідь на скаргу/запитання/реакцію).
-                # Блокуємо незалежно від часу, бо реальне повторне замовлення
-                # на ті самі дані — велика рідкість.
-                if sig == last_sig:
-                    logger.info("Duplicate order blocked (identical to last order, any time)")
-                    context.chat_data.pop("awaiting_missing", None)
-                    context.chat_data["dup_clarify_pending"] = True  # чекаємо підтвердження нового замовлення
-                    # Не мовчимо повністю — питаємо, чи це нове замовлення
-                    clarify = ("Бачу, що дані збігаються з вашим попереднім замовленням. "
-                               "Ви хочете оформити ще одне таке саме замовлення, чи це запитання щодо вже оформленого? "
-                               "Якщо потрібне нове — напишіть, будь ласка, «так, нове замовлення».")
-                    history.append({"role": "user", "content": raw_user_message})
-                    history.append({"role": "assistant", "content": clarify})
-                    await msg.reply_text(clarify)
-                    return
+        # Перевірка дублікатів (Рівень 3) — індексний пошук у журналі замовлень; пропускаємо для відредагованих
+        dup_override = context.chat_data.pop("dup_override", False)
+        if not parsed.edited and not dup_override:
+            with metrics.span("dup_checks"):
+                try:
+                    dup = await asyncio.to_thread(ledger.find_duplicate, msg.chat.id, tools.order_signature(parsed),
+                                                  tools.items_signature(parsed), parsed.phone,
+                                                  config.ORDER_DUP_WINDOW_SEC, config.ORDER_COOLDOWN_SEC)
+                except Exception as e:
+                    logger.error(f"Order ledger lookup error: {e}")
+                    dup = None
+            # exact_recent: та сама сигнатура в цьому чаті за 20 хв;
+            # items_recent: ті самі товари в цьому чаті за 3 хв (не довше — щоб не заблокувати
+            # те саме замовлення для іншої людини) — в обох випадках мовчки блокуємо
+            if dup in ("exact_recent", "items_recent"):
+                logger.info(f"Duplicate order blocked ({dup})")
+                metrics.mark_branch("duplicate")
+                context.chat_data.pop("awaiting_missing", None)
+                return
+            # ДОВГОСТРОКОВИЙ захист: якщо телефон+товари ІДЕНТИЧНІ будь-якому попередньому
+            # замовленню (в тому числі з іншого чату) — це майже напевно помилкове дублювання
+            # (GPT повторив замовлення з історії у відповідь на скаргу/запитання/реакцію).
+            if dup == "identical":
+                logger.info("Duplicate order blocked (identical to a past order)")
+                metrics.mark_branch("duplicate")
+                context.chat_data.pop("awaiting_missing", None)
+                context.chat_data["dup_clarify_pending"] = True  # чекаємо підтвердження нового замовлення
+                # Не мовчимо повністю — питаємо, чи це нове замовлення
+                clarify = ("Бачу, що дані збігаються з вашим попереднім замовленням. "
+                           "Ви хочете оформити ще одне таке саме замовлення, чи це запитання щодо вже оформленого? "
+                           "Якщо потрібне нове — напишіть, будь ласка, «так, нове замовлення».")
+                history.append({"role": "user", "content": raw_user_message})
+                history.append({"role": "assistant", "content": clarify})
+                await outbound.reply(msg, clarify)
+                return
 
         summary = tools.render_order(parsed)
-        context.chat_data["last_order_sig"] = sig
-        context.chat_data["last_order_time"] = time.time()
+        await record_order(parsed, msg.chat.id, msg.from_user.username if msg.from_user else None, "client")
         context.chat_data["order_completed_at"] = time.time()  # <-- мітка завершення
         context.chat_data["last_order_total"] = tools.calc_order_total(parsed)  # <-- сума для крипти
         context.chat_data.pop("awaiting_missing", None)
@@ -281,17 +574,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         history.append({"role": "user", "content": raw_user_message})
         history.append({"role": "assistant", "content": summary})
-        await msg.reply_text(summary)
+        await outbound.reply(msg, summary)
 
         if parsed.edited:
-            await msg.reply_text("Замовлення оновлено! 😊")
+            await outbound.reply(msg, "Замовлення оновлено! 😊")
         else:
-            await msg.reply_text("Дякуємо за замовлення, воно буде відправлено протягом 24 годин. 😊")
+            await outbound.reply(msg, "Дякуємо за замовлення, воно буде відправлено протягом 24 годин. 😊")
         
         # === АВТО-ПОВІДОМЛЕННЯ З КОДАМИ ===
         post_order_text = tools.render_post_order_info(parsed)
         if post_order_text:
-            await msg.reply_text(post_order_text)
+            await outbound.reply(msg, post_order_text)
 
         # === Пересилання в групу замовлень ===
         forward_text = summary.rstrip()
@@ -299,33 +592,35 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             forward_text += "\n\n⚠️ Примітка: Замовлення відредаговане клієнтом. Потребує перевірки."
         if msg.from_user and msg.from_user.username:
             forward_text = f"@{msg.from_user.username}\n{forward_text}"
-        try: await context.bot.send_message(config.ORDER_FORWARD_CHAT_ID, forward_text)
-        except Exception as e: logger.warning(f"Forward error: {e}")
+        await forward_to_group(context, forward_text)
         return
 
     # Б) Крипто-оплата
     if tools.try_parse_crypto_json(reply_text):
+        metrics.mark_branch("crypto")
         total_uah = context.chat_data.get("last_order_total", 0)
         if total_uah > 0:
             crypto_text = tools.render_crypto_payment(total_uah)
             history.append({"role": "user", "content": raw_user_message})
             history.append({"role": "assistant", "content": crypto_text})
-            await msg.reply_text(crypto_text, parse_mode="Markdown")
+            await outbound.reply(msg, crypto_text, parse_mode="Markdown")
         else:
             fallback = "Спершу потрібно оформити замовлення, щоб я міг розрахувати суму для оплати криптою."
             history.append({"role": "user", "content": raw_user_message})
             history.append({"role": "assistant", "content": fallback})
-            await msg.reply_text(fallback)
+            await outbound.reply(msg, fallback)
         return
 
     # В) Запит цін
-    price_countries = tools.try_parse_price_json(reply_text)
-    if price_countries is not None:
+    price_reply = tools.try_parse_price_reply(reply_text)
+    if price_reply is not None:
+        metrics.mark_branch("price_local" if local_intent else "price")
+        price_countries = price_reply.countries
         want_all = any(str(c).upper() == "ALL" for c in price_countries)
         keys_to_show = list(config.PRICE_TIERS.keys()) if want_all else [tools.normalize_country(str(c)).upper() for c in price_countries if str(c).strip()]
         
         valid, out_of_stock, invalid = [], {}, []
-        for k in set(keys_to_show):
+        for k in dict.fromkeys(keys_to_show):  # без дублів, у порядку запиту (для ALL — порядок прайсу)
             if k in config.PRICE_TIERS:
                 st, r = config.get_availability(k)
                 if st == "+": valid.append(k)
@@ -336,43 +631,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.chat_data["last_price_countries"] = [k for k in (keys_to_show if want_all else valid) if k in config.PRICE_TIERS]
 
         if valid:
-            txt = tools.render_prices(valid)
+            with metrics.span("render"):
+                txt = tools.render_all_prices() if want_all else tools.render_prices(valid)
             history.append({"role": "user", "content": raw_user_message})
             history.append({"role": "assistant", "content": txt})
-            await msg.reply_text(txt)
-        if out_of_stock: await msg.reply_text(tools.render_out_of_stock(out_of_stock))
-        if invalid: await msg.reply_text(tools.render_unavailable(invalid))
-        if not valid and not out_of_stock and not invalid and want_all: await msg.reply_text("На жаль, наразі всі SIM-карти відсутні.")
+        # Якщо модель не повернула комбіновану схему — follow-up запускаємо паралельно з відправкою прайсу;
+        # прайс уже в історії, тож follow-up бачить, що клієнту показано
+        follow_task = None
+        if not price_reply.has_followup:
+            follow_task = asyncio.create_task(ai.ask_gpt_followup(list(history), user_payload))
+        if valid: await outbound.reply(msg, txt)
+        if out_of_stock: await outbound.reply(msg, tools.render_out_of_stock(out_of_stock))
+        if invalid: await outbound.reply(msg, tools.render_unavailable(invalid))
+        if not valid and not out_of_stock and not invalid and want_all: await outbound.reply(msg, "На жаль, наразі всі SIM-карти відсутні.")
 
         # Follow-up
-        follow = await ai.ask_gpt_followup(history, user_payload)
-        ussd = tools.try_parse_ussd_json(follow)
+        if follow_task:
+            await outbound.flush()  # прайс клієнт бачить одразу, не чекаючи follow-up
+            with metrics.span("followup_gpt"):
+                follow = await follow_task
+            ussd = tools.try_parse_ussd_json(follow)
+        else:
+            follow, ussd = price_reply.followup, price_reply.ussd_targets
         if ussd:
             txt = tools.render_ussd_targets(ussd) or tools.FALLBACK_PLASTIC_MSG
             history.append({"role": "assistant", "content": txt})
-            await msg.reply_text(txt)
+            await outbound.reply(msg, txt)
             context.chat_data.pop("awaiting_missing", None)
             return
         if tools.is_meaningful_followup(follow):
             history.append({"role": "assistant", "content": follow})
-            await msg.reply_text(follow)
+            await outbound.reply(msg, follow)
         context.chat_data.pop("awaiting_missing", None)
         return
 
     # Г) Запит USSD
     ussd_targets = tools.try_parse_ussd_json(reply_text)
     if ussd_targets is not None:
+        metrics.mark_branch("ussd_local" if local_intent else "ussd")
         if ussd_targets:
             txt = tools.render_ussd_targets(ussd_targets) or tools.FALLBACK_PLASTIC_MSG
             history.append({"role": "user", "content": raw_user_message})
             history.append({"role": "assistant", "content": txt})
             context.chat_data.pop("awaiting_missing", None)
-            await msg.reply_text(txt)
+            await outbound.reply(msg, txt)
         else:
             txt = "Будь ласка, уточніть, для якої країни вам потрібна USSD-комбінація?"
             history.append({"role": "user", "content": raw_user_message})
             history.append({"role": "assistant", "content": txt})
-            await msg.reply_text(txt)
+            await outbound.reply(msg, txt)
         return
 
     # Ґ) Звичайний текст або уточнення пунктів
@@ -382,17 +689,67 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if context.chat_data.get("awaiting_missing") != {1, 2, 3}: context.chat_data.pop("awaiting_missing", None)
     
     if reply_text:
+        metrics.mark_branch("free_text")
         history.append({"role": "user", "content": raw_user_message})
         history.append({"role": "assistant", "content": reply_text})
-        await msg.reply_text(reply_text)
+        if streamed_msg:
+            # Фінальне редагування: повний текст (після виправлень вище)
+            if streamed_msg.text != reply_text:
+                try: await outbound.send_queue.submit(msg.chat.id, functools.partial(streamed_msg.edit_text, reply_text))
+                except Exception as e: logger.warning(f"Stream final edit error: {e}")
+        else:
+            await outbound.reply(msg, reply_text)
 
 # ===== Запуск =====
 def main():
     if not config.TELEGRAM_TOKEN or not config.OPENAI_API_KEY or not config.WEBHOOK_URL:
         raise RuntimeError("Не задано TELEGRAM_BOT_TOKEN, OPENAI_API_KEY або WEBHOOK_URL")
     
-    app = Application.builder().token(config.TELEGRAM_TOKEN).build()
+    inventory.load_file()  # зовнішній файл прайсів/наявності, якщо є
+    persistence = storage.SQLitePersistence(
+        config.CHAT_DB_PATH,
+        update_interval=config.PERSISTENCE_FLUSH_SEC,
+        idle_evict_sec=config.CHAT_IDLE_EVICT_SEC,
+        max_resident_chats=config.MAX_RESIDENT_CHATS,
+        disk_retention_sec=config.CHAT_DISK_RETENTION_DAYS * 24 * 3600,
+    )
+
+    metrics.register_gauge("bot_resident_chats", "Чатів у пам'яті", lambda: persistence.resident_stats(app)["resident_chats"])
+    metrics.register_gauge("bot_resident_chat_bytes", "Приблизний обсяг chat_data у пам'яті (байти pickle)", lambda: persistence.resident_stats(app)["approx_bytes"])
+    metrics.register_gauge("bot_busy_chats", "Чатів, що зараз обробляються або чекають у черзі", scheduler.chat_locks.busy_chats)
+    metrics.register_gauge("bot_coalesced_messages", "Повідомлень, приєднаних до серії (накопичувально)", lambda: coalescer.absorbed)
+    metrics.register_gauge("telegram_send_queue_depth", "Повідомлень у черзі на відправку", outbound.send_queue.depth)
+    metrics.register_gauge("telegram_outbox_failed", "Пересилань, відхилених Telegram (лишились в outbox як failed)", lambda: outbound.send_queue.dead)
+    metrics.register_gauge("bot_background_queue_depth", "Фонових завдань у черзі", background.depth)
+    metrics.register_gauge("bot_background_failed", "Фонових завдань, що не вдались після всіх повторів", lambda: background.failed)
+    metrics_server = None
+    outbox = storage.OutboxStore(config.OUTBOX_DB_PATH)
+
+    async def post_init(application: Application):
+        nonlocal metrics_server
+        persistence.start_eviction(application, interval=config.CHAT_EVICT_INTERVAL_SEC)
+        inventory.start_watch(config.INVENTORY_POLL_SEC)
+        await outbound.send_queue.start(application.bot, outbox)
+        background.start()
+        if config.METRICS_PORT:
+            metrics_server = await metrics.start_metrics_server("0.0.0.0", config.METRICS_PORT)
+
+    async def post_stop(application: Application):
+        persistence.stop_eviction()
+        inventory.stop_watch()
+        await background.stop()  # фонові видалення йдуть через send_queue — зупиняємо до неї
+        await outbound.send_queue.stop()
+        outbox.close()
+        ledger.close()
+        if metrics_server: metrics_server.close()
+
+    app = (Application.builder().token(config.TELEGRAM_TOKEN).persistence(persistence)
+           .concurrent_updates(config.CONCURRENT_UPDATES).post_init(post_init).post_stop(post_stop).build())
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("reload", reload_inventory))
+    app.add_handler(CommandHandler("stock", stock_command))
+    app.add_handler(CommandHandler("price", price_command))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"), import_orders_file))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     app.run_webhook(listen="0.0.0.0", port=config.PORT, url_path="", webhook_url=config.WEBHOOK_URL)
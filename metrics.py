@@ -0,0 +1,169 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ==== Метрики у форматі Prometheus (без зовнішніх залежностей) ====
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _labels_key(labels: Optional[Dict[str, str]]) -> LabelKey:
+    return tuple(sorted((labels or {}).items()))
+
+def _fmt_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs: return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help = name, help_text
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, labels: Optional[Dict[str, str]] = None, value: float = 1) -> None:
+        key = _labels_key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, labels: Optional[Dict[str, str]] = None) -> float:
+        return self._values.get(_labels_key(labels), 0)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_fmt_labels(k)} {v}" for k, v in self._values.items()]
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: List[float]):
+        self.name, self.help, self.buckets = name, help_text, sorted(buckets)
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = {}
+
+    def observe(self, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        key = _labels_key(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, b in enumerate(self.buckets):
+            if value <= b: counts[i] += 1
+        counts[-1] += 1  # +Inf
+        self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts in self._counts.items():
+            for b, c in zip(self.buckets, counts):
+                out.append(f"{self.name}_bucket{_fmt_labels(key, ('le', str(b)))} {c}")
+            out.append(f"{self.name}_bucket{_fmt_labels(key, ('le', '+Inf'))} {counts[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(key)} {self._sums[key]}")
+            out.append(f"{self.name}_count{_fmt_labels(key)} {counts[-1]}")
+        return out
+
+_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30]
+_TOKEN_BUCKETS = [50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000]
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Повний час обробки одного апдейту", _LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Час етапів handle_message", _LATENCY_BUCKETS)
+BRANCH_TOTAL = Counter("bot_branch_total", "Якою гілкою завершилась обробка повідомлення")
+OPENAI_SECONDS = Histogram("openai_request_seconds", "Затримка запитів до OpenAI", _LATENCY_BUCKETS)
+OPENAI_TOKENS = Histogram("openai_tokens", "Токени на запит до OpenAI (type=prompt|cached|completion)", _TOKEN_BUCKETS)
+OPENAI_ERRORS = Counter("openai_errors_total", "Помилки запитів до OpenAI (після всіх повторів)")
+RESPONSE_CACHE = Counter("bot_response_cache_total", "Звернення до кешу відповідей (result=hit|miss)")
+SEND_RETRIES = Counter("telegram_send_retries_total", "Повтори відправки в Telegram (reason=retry_after|network)")
+
+_REGISTRY = [HANDLER_SECONDS, STAGE_SECONDS, BRANCH_TOTAL, OPENAI_SECONDS, OPENAI_TOKENS, OPENAI_ERRORS, RESPONSE_CACHE,
+             SEND_RETRIES]
+_GAUGES: Dict[str, Tuple[str, Callable[[], float]]] = {}
+
+def register(metric) -> None:
+    _REGISTRY.append(metric)
+
+def register_gauge(name: str, help_text: str, fn: Callable[[], float]) -> None:
+    """Gauge, що обчислюється в момент збору метрик."""
+    _GAUGES[name] = (help_text, fn)
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for m in _REGISTRY: lines += m.render()
+    for name, (help_text, fn) in _GAUGES.items():
+        try: value = fn()
+        except Exception as e:
+            logger.warning(f"Gauge {name} error: {e}")
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+# ==== Спани етапів ====
+# Спани одного апдейту збираються в contextvar і в кінці логуються одним структурованим рядком.
+_trace: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar("bot_trace", default=None)
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, {"stage": stage})
+        trace = _trace.get()
+        if trace is not None:
+            trace["stages"][stage] = round(trace["stages"].get(stage, 0.0) + elapsed, 4)
+
+def mark_branch(branch: str) -> None:
+    """Позначає гілку обробки; остання позначка перемагає (order → duplicate) і рахується один раз."""
+    trace = _trace.get()
+    if trace is not None: trace["branch"] = branch
+    else: BRANCH_TOTAL.inc({"branch": branch})
+
+def traced(handler):
+    """Декоратор хендлера: загальний час, спани етапів і гілка — в гістограми та в лог."""
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        trace = {"chat_id": update.effective_chat.id if update.effective_chat else None, "branch": None, "stages": {}}
+        token = _trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await handler(update, context, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            _trace.reset(token)
+            HANDLER_SECONDS.observe(elapsed)
+            if trace["branch"]:
+                BRANCH_TOTAL.inc({"branch": trace["branch"]})
+                trace["total"] = round(elapsed, 4)
+                logger.info("timing " + json.dumps(trace, ensure_ascii=False))
+    return wrapper
+
+def observe_openai(kind: str, elapsed: float, prompt: int, cached: int, completion: int) -> None:
+    labels = {"kind": kind}
+    OPENAI_SECONDS.observe(elapsed, labels)
+    OPENAI_TOKENS.observe(prompt, {"kind": kind, "type": "prompt"})
+    OPENAI_TOKENS.observe(cached, {"kind": kind, "type": "cached"})
+    OPENAI_TOKENS.observe(completion, {"kind": kind, "type": "completion"})
+
+# ==== HTTP-ендпоінт /metrics ====
+# run_webhook у PTB не дозволяє додавати маршрути, тому /metrics слухає окремий порт
+# (мінімальний HTTP-сервер на asyncio, без додаткових залежностей).
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = (await asyncio.wait_for(reader.readline(), 5)).decode("latin-1")
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body, status, ctype = render_metrics().encode(), "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, ctype = b"not found\n", "404 Not Found", "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Metrics HTTP error: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    return server
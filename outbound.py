@@ -0,0 +1,323 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ==== Черга відправки з урахуванням лімітів Telegram ====
+# Усі відповіді й пересилання проходять через одну чергу з пріоритетами:
+# - глобальний token bucket (ліміт бота) і per-chat bucket (приватні чати ~1/с, групи ~20/хв);
+# - RetryAfter (flood control) ставить на паузу всю відправку на вказаний час і повторює запит;
+# - мережеві помилки повторюються з експоненційною затримкою;
+# - «durable» повідомлення (пересилання замовлень у групу) спершу пишуться в outbox (SQLite)
+#   і видаляються лише після доставки — після рестарту недоставлені відправляються знову;
+#   якщо Telegram відхилив таке повідомлення (BadRequest/Forbidden), рядок лишається позначеним як failed.
+PRIORITY_ORDER = 0  # пересилання замовлень — першими
+PRIORITY_REPLY = 1
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated = capacity, time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """0 — токен узято; інакше — скільки секунд чекати до наступного токена."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        while True:
+            delay = self.wait_time()
+            if not delay: return
+            await asyncio.sleep(delay)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+@dataclass
+class _Job:
+    priority: int
+    chat_id: int
+    send: Callable[[], Awaitable[Any]]
+    future: Optional[asyncio.Future] = None
+    outbox_id: Optional[int] = None
+    attempts: int = 0
+
+def _retry_after_sec(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+class SendQueue:
+    """Пріоритетна черга «квитків» (priority, seq, chat_id) + FIFO-черга завдань на кожен чат.
+    Воркер за квитком бере найстаріше завдання чату, тож порядок повідомлень у чаті зберігається,
+    навіть коли кілька воркерів і повтори перемішують квитки."""
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, workers: int, max_attempts: int = 5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate, self.group_rate = chat_rate, group_rate
+        self.workers, self.max_attempts = workers, max_attempts
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._jobs: Dict[int, Deque[_Job]] = {}
+        self._busy: Set[int] = set()            # чати, в які зараз іде відправка
+        self._not_before: Dict[int, float] = {}  # чат чекає на повтор до цього часу
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._bot = None
+        self._outbox = None
+        self.dead = 0  # durable-повідомлень, які Telegram відхилив (лишились в outbox як failed)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self._jobs.values())
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 5000:  # прибираємо відпочилі бакети
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.is_full()}
+            # chat_id < 0 — групи/канали: ліміт на хвилину, з невеликим запасом на сплеск
+            bucket = TokenBucket(self.group_rate, 3) if chat_id < 0 else TokenBucket(self.chat_rate, 3)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def start(self, bot, outbox=None) -> None:
+        self._bot, self._outbox = bot, outbox
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if outbox is not None:
+            self.dead = await asyncio.to_thread(outbox.failed_count)
+            pending = await asyncio.to_thread(outbox.pending)
+            for row in pending:
+                self._put(self._durable_job(row["id"], row["chat_id"], row["text"], row["kwargs"], row["priority"]))
+            if pending: logger.info(f"Outbox: re-queued {len(pending)} undelivered message(s)")
+
+    async def stop(self) -> None:
+        for t in self._tasks: t.cancel()
+        self._tasks = []
+
+    def _ticket(self, priority: int, chat_id: int, delay: float = 0.0) -> None:
+        ticket = (priority, next(self._seq), chat_id)
+        if delay > 0: asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, ticket)
+        else: self._queue.put_nowait(ticket)
+
+    def _put(self, job: _Job) -> None:
+        self._jobs.setdefault(job.chat_id, deque()).append(job)
+        self._ticket(job.priority, job.chat_id)
+
+    def _retry(self, job: _Job, delay: float) -> None:
+        """Повертає завдання на початок черги чату — наступні повідомлення чату чекають на нього."""
+        self._jobs.setdefault(job.chat_id, deque()).appendleft(job)
+        self._not_before[job.chat_id] = time.monotonic() + delay
+        self._ticket(job.priority, job.chat_id, delay)
+
+    def _durable_job(self, outbox_id: int, chat_id: int, text: str, kwargs: Dict[str, Any], priority: int) -> _Job:
+        send = lambda: self._bot.send_message(chat_id, text, **kwargs)
+        return _Job(priority, chat_id, send, outbox_id=outbox_id)
+
+    async def submit(self, chat_id: int, send: Callable[[], Awaitable[Any]], priority: int = PRIORITY_REPLY):
+        """Відправка через чергу з очікуванням результату (відповідь клієнту)."""
+        if not self.running: return await send()
+        future = asyncio.get_running_loop().create_future()
+        self._put(_Job(priority, chat_id, send, future=future))
+        return await future
+
+    async def send_durable(self, bot, chat_id: int, text: str, priority: int = PRIORITY_ORDER, **kwargs) -> None:
+        """Повідомлення з гарантією доставки: пишеться в outbox і відправляється у фоні."""
+        if not self.running or self._outbox is None:
+            await _guarded(lambda: bot.send_message(chat_id, text, **kwargs))
+            return
+        outbox_id = await asyncio.to_thread(self._outbox.add, chat_id, text, kwargs, priority)
+        self._put(self._durable_job(outbox_id, chat_id, text, kwargs, priority))
+
+    async def _worker(self) -> None:
+        while True:
+            priority, _, chat_id = await self._queue.get()
+            jobs = self._jobs.get(chat_id)
+            if not jobs: continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0: await asyncio.sleep(pause)
+            wait = self._not_before.get(chat_id, 0) - time.monotonic()
+            if chat_id in self._busy or wait > 0:
+                self._ticket(priority, chat_id, max(wait, 0.05))
+                continue
+            wait = self._chat_bucket(chat_id).wait_time()
+            if wait:
+                self._ticket(priority, chat_id, wait)  # не блокуємо воркера одним «гарячим» чатом
+                continue
+            job = jobs.popleft()
+            if not jobs: del self._jobs[chat_id]
+            self._not_before.pop(chat_id, None)
+            self._busy.add(chat_id)
+            try:
+                await self.global_bucket.acquire()
+                await self._attempt(job)
+            finally:
+                self._busy.discard(chat_id)
+
+    async def _attempt(self, job: _Job) -> None:
+        try:
+            result = await job.send()
+        except RetryAfter as e:
+            delay = _retry_after_sec(e)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            metrics.SEND_RETRIES.inc({"reason": "retry_after"})
+            logger.warning(f"Telegram flood control: pausing sends for {delay:.0f}s")
+            self._retry(job, delay)  # RetryAfter не рахується як невдала спроба
+            return
+        except (BadRequest, Forbidden) as e:
+            await self._finish(job, error=e)  # повтор не допоможе
+            return
+        except NetworkError as e:  # включно з TimedOut
+            job.attempts += 1
+            if job.outbox_id is not None:
+                await asyncio.to_thread(self._outbox.bump_attempts, job.outbox_id)
+            elif job.attempts >= self.max_attempts:
+                await self._finish(job, error=e)
+                return
+            delay = min(60.0, 0.5 * 2 ** job.attempts) * random.uniform(0.8, 1.2)
+            metrics.SEND_RETRIES.inc({"reason": "network"})
+            logger.warning(f"Send to {job.chat_id} failed ({e}), retry in {delay:.1f}s")
+            self._retry(job, delay)
+            return
+        except Exception as e:
+            await self._finish(job, error=e)
+            return
+        await self._finish(job, result=result)
+
+    async def _finish(self, job: _Job, result: Any = None, error: Optional[Exception] = None) -> None:
+        if job.outbox_id is not None:
+            try:
+                if error:
+                    # Замовлення не доставлено — рядок не видаляємо, лише знімаємо з повторів
+                    logger.error(f"Outbox message {job.outbox_id} to {job.chat_id} failed: {error}")
+                    await asyncio.to_thread(self._outbox.fail, job.outbox_id, f"{type(error).__name__}: {error}")
+                    self.dead += 1
+                else:
+                    await asyncio.to_thread(self._outbox.done, job.outbox_id)
+            except Exception as e: logger.error(f"Outbox update error: {e}")
+        if job.future is not None and not job.future.done():
+            if error: job.future.set_exception(error)
+            else: job.future.set_result(result)
+        elif error and job.outbox_id is None:
+            logger.warning(f"Send to {job.chat_id} failed: {error}")
+
+send_queue = SendQueue(config.SEND_GLOBAL_RATE, config.SEND_CHAT_RATE, config.SEND_GROUP_RATE_PER_MIN / 60, config.SEND_WORKERS)
+
+# ==== Пакетна відправка відповідей ====
+# Хендлер не шле кожну відповідь окремим запитом до Telegram, а складає їх у пакет:
+# - відповіді клієнту, що йдуть підряд, склеюються в одне повідомлення (якщо влазять у ліміт
+#   і мають однаковий parse_mode) — замість 3–4 послідовних round trip лишається один;
+# Пакет відправляється в кінці хендлера або раніше через flush() — напр. перед довгим очікуванням GPT.
+TELEGRAM_TEXT_LIMIT = 4096
+_SEPARATOR = "\n\n"
+
+@dataclass
+class _Reply:
+    text: str
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+
+class ReplyBatch:
+    def __init__(self, msg):
+        self.msg = msg
+        self._replies: List[_Reply] = []
+
+    def add_reply(self, text: str, **kwargs) -> None:
+        if not text: return
+        last = self._replies[-1] if self._replies else None
+        if (last and last.kwargs == kwargs and not kwargs.get("reply_markup")
+                and len(last.text) + len(_SEPARATOR) + len(text) <= TELEGRAM_TEXT_LIMIT):
+            last.text = last.text.rstrip() + _SEPARATOR + text.lstrip()
+        else:
+            self._replies.append(_Reply(text, dict(kwargs)))
+
+    async def _send_replies(self, replies: List[_Reply]) -> None:
+        for r in replies:  # відповіді клієнту — строго по черзі
+            try: await send_queue.submit(self.msg.chat.id, functools.partial(self.msg.reply_text, r.text, **r.kwargs))
+            except Exception as e: logger.warning(f"Reply send error: {e}")
+
+    async def flush(self) -> None:
+        replies, self._replies = self._replies, []
+        if not replies: return
+        with metrics.span("send"):
+            await self._send_replies(replies)
+
+async def _guarded(send: Callable[[], Awaitable[Any]]) -> None:
+    try: await send()
+    except Exception as e: logger.warning(f"Send error: {e}")
+
+_batch: contextvars.ContextVar[Optional[ReplyBatch]] = contextvars.ContextVar("reply_batch", default=None)
+
+def batched(handler):
+    """Декоратор хендлера: відповіді на effective_message збираються в пакет і відправляються в кінці."""
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        batch = ReplyBatch(update.effective_message)
+        token = _batch.set(batch)
+        try:
+            return await handler(update, context, *args, **kwargs)
+        finally:
+            _batch.reset(token)
+            await batch.flush()
+    return wrapper
+
+async def reply(msg, text: str, **kwargs) -> None:
+    """Відповідь клієнту: у пакет, якщо хендлер обгорнутий batched, інакше — одразу."""
+    batch = _batch.get()
+    if batch is not None and batch.msg is msg:
+        batch.add_reply(text, **kwargs)
+        return
+    with metrics.span("send"):
+        await send_queue.submit(msg.chat.id, functools.partial(msg.reply_text, text, **kwargs))
+
+async def send_message(bot, chat_id: int, text: str, **kwargs) -> Any:
+    """Повідомлення в чат (напр. у групу замовлень) через чергу — з її лімітами й повторами при RetryAfter."""
+    with metrics.span("send"):
+        return await send_queue.submit(chat_id, functools.partial(bot.send_message, chat_id, text, **kwargs))
+
+async def delete_message(bot, chat_id: int, message_id: int) -> Any:
+    return await send_queue.submit(chat_id, functools.partial(bot.delete_message, chat_id, message_id))
+
+async def send_durable(bot, chat_id: int, text: str, **kwargs) -> None:
+    """Повідомлення з гарантією доставки (outbox) і найвищим пріоритетом — для пересилання замовлень."""
+    await send_queue.send_durable(bot, chat_id, text, PRIORITY_ORDER, **kwargs)
+
+def pack_texts(texts: List[str], separator: str = _SEPARATOR) -> List[str]:
+    """Складає тексти по порядку в мінімум повідомлень до TELEGRAM_TEXT_LIMIT, не розриваючи жоден текст."""
+    packed: List[str] = []
+    for text in texts:
+        if packed and len(packed[-1]) + len(separator) + len(text) <= TELEGRAM_TEXT_LIMIT:
+            packed[-1] += separator + text
+        else:
+            packed.append(text)
+    return packed
+
+async def flush() -> None:
+    """Відправити накопичене зараз (перед довгою операцією, щоб клієнт не чекав)."""
+    batch = _batch.get()
+    if batch is not None: await batch.flush()
@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ==== Послідовна обробка в межах чату ====
+# Апдейти різних чатів обробляються паралельно (concurrent_updates у Application),
+# а всередині одного чату — строго по черзі: handle_message змінює chat_data між
+# кількома await, і два швидкі повідомлення одного клієнта не повинні перетинатися.
+class ChatLocks:
+    """Per-chat asyncio.Lock з автоматичним прибиранням, щоб словник не ріс безмежно."""
+
+    def __init__(self):
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._users: Dict[int, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._users[chat_id] = self._users.get(chat_id, 0) + 1
+        try:
+            async with lock:  # asyncio.Lock — FIFO, тож порядок повідомлень зберігається
+                yield
+        finally:
+            self._users[chat_id] -= 1
+            if not self._users[chat_id]:
+                del self._users[chat_id]
+                del self._locks[chat_id]
+
+    def busy_chats(self) -> int:
+        return len(self._locks)
+
+    def is_busy(self, chat_id: int) -> bool:
+        """Чат зараз обробляється або має апдейти в черзі на лок."""
+        return chat_id in self._locks
+
+chat_locks = ChatLocks()
+
+def per_chat_serialized(handler):
+    """Декоратор для PTB-хендлерів: виконує хендлер під локом чату поточного апдейту."""
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        chat = update.effective_chat
+        if not chat:
+            return await handler(update, context, *args, **kwargs)
+        async with chat_locks.hold(chat.id):
+            return await handler(update, context, *args, **kwargs)
+    return wrapper
+
+# ==== Склеювання серії повідомлень ====
+# Клієнти часто шлють ПІБ, телефон, місто й товари 3–4 окремими повідомленнями за кілька секунд.
+# Перше повідомлення серії стає «лідером»: чекає, поки чат помовчить window секунд (але не довше
+# max_wait), збирає всі тексти і запускає хендлер один раз. Решта повідомлень серії лише додають текст
+# (і цитату, якщо повідомлення було відповіддю на інше).
+@dataclass
+class _Burst:
+    texts: List[str]
+    last_at: float
+    started_at: float
+    quotes: List[str] = field(default_factory=list)
+    event: asyncio.Event = field(default_factory=asyncio.Event)
+
+class MessageCoalescer:
+    def __init__(self, window: float, max_wait: float):
+        self.window = window
+        self.max_wait = max_wait
+        self._bursts: Dict[int, _Burst] = {}
+        self.absorbed = 0  # скільки повідомлень було приєднано до чужої серії
+
+    async def collect(self, chat_id: int, text: str, quote: Optional[str] = None) -> Optional[Tuple[str, List[str]]]:
+        """Повертає склеєний текст і цитати серії (без повторів) для лідера або None, якщо повідомлення
+        приєднане до серії."""
+        now = time.monotonic()
+        burst = self._bursts.get(chat_id)
+        if burst:
+            burst.texts.append(text)
+            if quote and quote not in burst.quotes: burst.quotes.append(quote)
+            burst.last_at = now
+            burst.event.set()
+            self.absorbed += 1
+            return None
+        burst = _Burst(texts=[text], last_at=now, started_at=now, quotes=[quote] if quote else [])
+        self._bursts[chat_id] = burst
+        try:
+            while True:
+                deadline = min(burst.last_at + self.window, burst.started_at + self.max_wait)
+                timeout = deadline - time.monotonic()
+                if timeout <= 0: break
+                burst.event.clear()
+                try: await asyncio.wait_for(burst.event.wait(), timeout)
+                except asyncio.TimeoutError: break
+        finally:
+            self._bursts.pop(chat_id, None)
+        if len(burst.texts) > 1:
+            logger.info(f"Coalesced {len(burst.texts)} messages in chat {chat_id}")
+        return "\n".join(burst.texts), burst.quotes
+
+def coalesce_messages(coalescer: MessageCoalescer, should_coalesce: Callable, quote_of: Optional[Callable] = None):
+    """Декоратор: передає хендлеру склеєний текст серії через kwarg `text`, а цитати всіх
+    повідомлень серії (quote_of(msg)) — через kwarg `quotes`."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            msg = update.effective_message
+            text = (msg.text or "").strip() if msg else ""
+            if coalescer.window <= 0 or not text or not update.effective_chat or not should_coalesce(update):
+                return await handler(update, context)
+            quote = quote_of(msg) if quote_of else None
+            merged = await coalescer.collect(update.effective_chat.id, text, quote)
+            if merged is None: return
+            text, quotes = merged
+            return await handler(update, context, text=text, quotes=quotes)
+        return wrapper
+    return decorator
+
+# ==== Фонові завдання ====
+# Побічні ефекти, на які ніхто не чекає, виконуються воркерами поза хендлером: хендлер лише ставить
+# завдання в чергу й одразу звільняється для наступного апдейту. Невдалі завдання повторюються з
+# експоненційною затримкою. Черга — в пам'яті, тож сюди йде лише те, втрата чого нешкідлива; журнал
+# замовлень пишеться в хендлері, а пересилання в групу — через outbox.
+@dataclass
+class _Task:
+    name: str
+    run: Callable[[], Awaitable]
+    attempts: int = 0
+
+class BackgroundWorker:
+    def __init__(self, workers: int = 2, max_attempts: int = 5, retry_base: float = 1.0):
+        self.workers, self.max_attempts, self.retry_base = workers, max_attempts, retry_base
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._detached: Set[asyncio.Task] = set()
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self) -> None:
+        if self._tasks: return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Дочікується черги (не довше timeout), потім зупиняє воркерів."""
+        if self._queue is not None:
+            try: await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError: logger.warning(f"Background queue not drained: {self._queue.qsize()} task(s) left")
+        for t in self._tasks: t.cancel()
+        self._tasks = []
+
+    def submit(self, name: str, run: Callable[[], Awaitable]) -> None:
+        task = _Task(name, run)
+        if self.running:
+            self._queue.put_nowait(task)
+        else:
+            # Воркери не запущені (бенчмарк, скрипти) — виконуємо окремою задачею
+            t = asyncio.create_task(self._run(task))
+            self._detached.add(t)
+            t.add_done_callback(self._detached.discard)
+
+    async def _run(self, task: _Task) -> None:
+        while True:
+            try:
+                await task.run()
+                return
+            except Exception as e:
+                task.attempts += 1
+                if task.attempts >= self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"Background task '{task.name}' failed after {task.attempts} attempt(s): {e}")
+                    return
+                delay = self.retry_base * 2 ** (task.attempts - 1)
+                logger.warning(f"Background task '{task.name}' error: {e}; retry in {delay:.0f}s")
+                await asyncio.sleep(delay)
+
+    async def _worker(self) -> None:
+        while True:
+            task = await self._queue.get()
+            try: await self._run(task)
+            finally: self._queue.task_done()
@@ -0,0 +1,389 @@
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import scheduler
+
+logger = logging.getLogger(__name__)
+
+# ==== SQLite-персистентність стану чатів ====
+# Зберігаємо лише chat_data (history, last_order_sig, awaiting_missing тощо).
+# - WAL-режим: читання не блокуються записом.
+# - Ліниве завантаження: при старті нічого не читаємо, чат підтягується з диска
+#   при першому апдейті від нього (через refresh_chat_data).
+# - Write-behind: зміни накопичуються і пишуться однією транзакцією на кожен прохід
+#   Application.update_persistence (раз на update_interval секунд) та при зупинці.
+# - Витіснення: чати, що довго мовчать (або найстаріші понад ліміт), зберігаються на диск
+#   і вивантажуються з пам'яті; при наступному повідомленні знову підтягуються ліниво.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_data (
+    chat_id    INTEGER PRIMARY KEY,
+    data       BLOB NOT NULL,
+    updated_at REAL NOT NULL DEFAULT (strftime('%s','now'))
+)
+"""
+
+class SQLiteChatStore:
+    """Синхронне сховище chat_data у SQLite. Всі виклики — з одного потоку через lock."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+
+    def load(self, chat_id: int) -> Optional[Dict[Any, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM chat_data WHERE chat_id = ?", (chat_id,)).fetchone()
+        if not row: return None
+        try: return pickle.loads(row[0])
+        except Exception as e:
+            logger.warning(f"Corrupted chat_data for {chat_id}: {e}")
+            return None
+
+    def save_many(self, items: Dict[int, bytes]) -> None:
+        if not items: return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO chat_data (chat_id, data, updated_at) VALUES (?, ?, strftime('%s','now')) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    list(items.items()),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def purge_older_than(self, max_age_sec: float) -> int:
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM chat_data WHERE updated_at < strftime('%s','now') - ?", (max_age_sec,))
+            return cur.rowcount
+
+    def delete(self, chat_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# ==== Журнал замовлень ====
+# Append-only таблиця всіх оформлених замовлень (клієнтських і введених менеджером).
+# Індекси по сигнатурах і телефону — перевірка дублів іде індексними запитами по всіх чатах,
+# а не лише по останньому замовленню чату.
+_ORDERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    chat_id    INTEGER,
+    username   TEXT,
+    source     TEXT NOT NULL,           -- client | manager
+    edited     INTEGER NOT NULL DEFAULT 0,
+    full_name  TEXT,
+    name_norm  TEXT,
+    phone      TEXT,                    -- лише цифри, останні 9 (без коду країни)
+    city       TEXT,
+    np         TEXT,
+    order_sig  TEXT NOT NULL,
+    items_sig  TEXT NOT NULL,
+    total      INTEGER,
+    data       TEXT NOT NULL            -- JSON замовлення
+);
+CREATE INDEX IF NOT EXISTS idx_orders_order_sig ON orders(order_sig, created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_chat_items ON orders(chat_id, items_sig, created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders(phone, created_at);
+"""
+
+def normalize_phone(phone: str) -> str:
+    digits = "".join(ch for ch in (phone or "") if ch.isdigit())
+    return digits[-9:]
+
+def normalize_name(name: str) -> str:
+    """ПІБ без урахування регістру й порядку слів: «Франко Іван» == «іван франко»."""
+    return " ".join(sorted((name or "").lower().replace("'", "").replace("’", "").split()))
+
+class OrderLedger:
+    """Синхронний журнал замовлень у SQLite. З async-коду викликати через asyncio.to_thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_ORDERS_SCHEMA)
+
+    def record(self, *, chat_id: Optional[int], username: Optional[str], source: str, full_name: str, phone: str,
+               city: str, np: str, order_sig: str, items_sig: str, total: Optional[int], data: Dict[str, Any],
+               edited: bool = False) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO orders (created_at, chat_id, username, source, edited, full_name, name_norm, phone, city, np, "
+                "order_sig, items_sig, total, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), chat_id, username, source, int(edited), full_name, normalize_name(full_name),
+                 normalize_phone(phone), city, np, order_sig, items_sig, total, json.dumps(data, ensure_ascii=False)),
+            )
+            return cur.lastrowid
+
+    def find_duplicate(self, chat_id: int, order_sig: str, items_sig: str, phone: str,
+                       dup_window: float, cooldown: float) -> Optional[str]:
+        """Тип дубля для нового замовлення або None:
+        exact_recent — та сама сигнатура в цьому чаті за dup_window;
+        items_recent — ті самі товари в цьому чаті за cooldown;
+        identical    — той самий телефон і ті самі товари будь-коли, в будь-якому чаті
+                       (без телефону — та сама сигнатура)."""
+        now = time.time()
+        with self._lock:
+            exact_recent = self._conn.execute(
+                "SELECT 1 FROM orders WHERE order_sig = ? AND created_at >= ? AND chat_id = ? LIMIT 1",
+                (order_sig, now - dup_window, chat_id),
+            ).fetchone()
+            if exact_recent: return "exact_recent"
+            items_recent = self._conn.execute(
+                "SELECT 1 FROM orders WHERE chat_id = ? AND items_sig = ? AND created_at >= ? LIMIT 1",
+                (chat_id, items_sig, now - cooldown),
+            ).fetchone()
+            if items_recent: return "items_recent"
+            # По телефону, а не по повній сигнатурі: інше написання міста/відділення не ховає дубль
+            phone = normalize_phone(phone)
+            if phone:
+                identical = self._conn.execute(
+                    "SELECT 1 FROM orders WHERE phone = ? AND items_sig = ? LIMIT 1", (phone, items_sig),
+                ).fetchone()
+            else:
+                identical = self._conn.execute("SELECT 1 FROM orders WHERE order_sig = ? LIMIT 1", (order_sig,)).fetchone()
+        return "identical" if identical else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# ==== Outbox вихідних повідомлень ====
+# Повідомлення з гарантією доставки (пересилання замовлень у групу) спершу пишуться сюди,
+# видаляються після успішної відправки. Після рестарту недоставлені ставляться в чергу знову.
+_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    chat_id    INTEGER NOT NULL,
+    text       TEXT NOT NULL,
+    kwargs     TEXT NOT NULL DEFAULT '{}',
+    priority   INTEGER NOT NULL DEFAULT 0,
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    failed_at  REAL,
+    error      TEXT
+)
+"""
+
+class OutboxStore:
+    """Синхронне сховище outbox у SQLite. Всі виклики — з одного потоку через lock."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_OUTBOX_SCHEMA)
+        columns = {r[1] for r in self._conn.execute("PRAGMA table_info(outbox)")}
+        for column, decl in (("failed_at", "REAL"), ("error", "TEXT")):  # outbox зі старих версій
+            if column not in columns: self._conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} {decl}")
+
+    def add(self, chat_id: int, text: str, kwargs: Dict[str, Any], priority: int) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO outbox (created_at, chat_id, text, kwargs, priority) VALUES (?, ?, ?, ?, ?)",
+                (time.time(), chat_id, text, json.dumps(kwargs, ensure_ascii=False), priority),
+            )
+            return cur.lastrowid
+
+    def done(self, outbox_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+
+    def fail(self, outbox_id: int, error: str) -> None:
+        """Відправка неможлива (BadRequest/Forbidden) — рядок лишається для розбору, але не повторюється."""
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET failed_at = ?, error = ? WHERE id = ?", (time.time(), error, outbox_id))
+
+    def failed_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE failed_at IS NOT NULL").fetchone()[0]
+
+    def bump_attempts(self, outbox_id: int) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (outbox_id,))
+
+    def pending(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, chat_id, text, kwargs, priority, attempts FROM outbox WHERE failed_at IS NULL ORDER BY id").fetchall()
+        return [{"id": r[0], "chat_id": r[1], "text": r[2], "kwargs": json.loads(r[3] or "{}"), "priority": r[4], "attempts": r[5]}
+                for r in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class SQLitePersistence(BasePersistence):
+    """Персистентність python-telegram-bot поверх SQLiteChatStore (лише chat_data)."""
+
+    def __init__(self, path: str, update_interval: float = 10, idle_evict_sec: float = 1800,
+                 max_resident_chats: int = 2000, disk_retention_sec: float = 0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = SQLiteChatStore(path)
+        self._loaded: Set[int] = set()       # чати, вже підтягнуті з диска в цьому процесі
+        self._pending: Dict[int, bytes] = {} # зміни, що чекають на запис
+        self._flush_scheduled = False
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._last_seen: Dict[int, float] = {}  # chat_id -> monotonic-час останнього апдейту
+        self._sizes: Dict[int, int] = {}        # chat_id -> розмір останнього pickle (для gauge)
+        self._approx_bytes = 0
+        self.idle_evict_sec = idle_evict_sec
+        self.max_resident_chats = max_resident_chats
+        self.disk_retention_sec = disk_retention_sec
+        self._evict_task: Optional[asyncio.Task] = None
+
+    # --- Читання ---
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}  # ліниве завантаження — див. refresh_chat_data
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        self._last_seen[chat_id] = time.monotonic()
+        loading = self._loading.get(chat_id)
+        if loading:
+            # Інші апдейти цього чату чекають на те саме завантаження — порядок обробки зберігається
+            await loading
+            return
+        if chat_id in self._loaded: return
+        self._loaded.add(chat_id)
+        if chat_data: return  # у пам'яті вже свіжіші дані
+        loading = asyncio.ensure_future(asyncio.to_thread(self.store.load, chat_id))
+        self._loading[chat_id] = loading
+        try:
+            stored = await loading
+            if stored: chat_data.update(stored)
+        finally:
+            self._loading.pop(chat_id, None)
+
+    # --- Запис (write-behind) ---
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        if chat_id not in self._loaded: return  # «привид» вивантаженого чату — не затираємо дані на диску
+        blob = pickle.dumps(data)
+        self._pending[chat_id] = blob
+        self._track_size(chat_id, len(blob))
+        if not self._flush_scheduled:
+            # Application оновлює всі змінені чати одним gather — пишемо їх однією транзакцією
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self._flush_pending()))
+
+    async def _flush_pending(self) -> None:
+        self._flush_scheduled = False
+        batch, self._pending = self._pending, {}
+        if not batch: return
+        try:
+            await asyncio.to_thread(self.store.save_many, batch)
+        except Exception as e:
+            logger.error(f"Chat state flush error: {e}")
+            for cid, blob in batch.items(): self._pending.setdefault(cid, blob)
+
+    def _track_size(self, chat_id: int, size: int) -> None:
+        self._approx_bytes += size - self._sizes.pop(chat_id, 0)
+        if size: self._sizes[chat_id] = size
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._pending.pop(chat_id, None)
+        self._track_size(chat_id, 0)
+        self._loaded.discard(chat_id)
+        self._last_seen.pop(chat_id, None)
+        await asyncio.to_thread(self.store.delete, chat_id)
+
+    async def flush(self) -> None:
+        await self._flush_pending()
+        self.store.close()
+
+    # --- Витіснення неактивних чатів ---
+    def _pick_victims(self, resident: Dict[int, Any]) -> List[int]:
+        now = time.monotonic()
+        # Записи, які PTB створив для вже вивантажених чатів, теж прибираємо
+        victims = {cid for cid in resident if cid not in self._loaded}
+        victims |= {cid for cid, ts in self._last_seen.items() if now - ts > self.idle_evict_sec}
+        live = sorted((ts, cid) for cid, ts in self._last_seen.items() if cid not in victims)
+        overflow = len(live) - self.max_resident_chats
+        if overflow > 0: victims |= {cid for _, cid in live[:overflow]}  # LRU
+        # Чат, що зараз обробляється, не чіпаємо: хендлер тримає посилання на його chat_data,
+        # і зміни після витіснення загубились би (update_chat_data ігнорує невантажені чати)
+        return [cid for cid in victims if not scheduler.chat_locks.is_busy(cid) and cid not in self._loading]
+
+    async def evict_idle_chats(self, application) -> int:
+        """Зберігає на диск і вивантажує з пам'яті неактивні чати. Повертає кількість вивантажених."""
+        # Публічного API «вивантажити лише з пам'яті» PTB не має (drop_chat_data стирає й диск)
+        resident = application._chat_data
+        victims = self._pick_victims(resident)
+        for cid in victims:
+            data = resident.pop(cid, None)
+            if data and cid in self._loaded: self._pending[cid] = pickle.dumps(data)
+            self._loaded.discard(cid)
+            self._last_seen.pop(cid, None)
+            self._track_size(cid, 0)
+        await self._flush_pending()
+        if self.disk_retention_sec > 0:
+            purged = await asyncio.to_thread(self.store.purge_older_than, self.disk_retention_sec)
+            if purged: logger.info(f"Purged {purged} stale chats from disk")
+        return len(victims)
+
+    def resident_stats(self, application) -> Dict[str, int]:
+        """Gauge: кількість чатів у пам'яті та приблизний обсяг їхніх даних — сума розмірів останніх
+        pickle з update_chat_data, без повторної серіалізації на кожен scrape."""
+        return {"resident_chats": len(application._chat_data), "approx_bytes": self._approx_bytes}
+
+    async def _eviction_loop(self, application, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                evicted = await self.evict_idle_chats(application)
+                if evicted:
+                    st = self.resident_stats(application)
+                    logger.info(f"Evicted {evicted} idle chats; resident={st['resident_chats']} ~{st['approx_bytes']} B")
+            except Exception as e:
+                logger.error(f"Chat eviction error: {e}")
+
+    def start_eviction(self, application, interval: float = 60) -> None:
+        if self._evict_task is None:
+            self._evict_task = asyncio.create_task(self._eviction_loop(application, interval))
+
+    def stop_eviction(self) -> None:
+        if self._evict_task is not None:
+            self._evict_task.cancel()
+            self._evict_task = None
+
+    # --- Невикористовувані типи даних ---
+    async def get_user_data(self) -> Dict[int, Any]: return {}
+    async def get_bot_data(self) -> Dict[Any, Any]: return {}
+    async def get_callback_data(self): return None
+    async def get_conversations(self, name: str) -> Dict: return {}
+    async def update_conversation(self, name: str, key, new_state) -> None: pass
+    async def update_user_data(self, user_id: int, data) -> None: pass
+    async def update_bot_data(self, data) -> None: pass
+    async def update_callback_data(self, data) -> None: pass
+    async def drop_user_data(self, user_id: int) -> None: pass
+    async def refresh_user_data(self, user_id: int, user_data) -> None: pass
+    async def refresh_bot_data(self, bot_data) -> None: pass
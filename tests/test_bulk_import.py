@@ -0,0 +1,44 @@
+import pytest
+
+import tools
+
+IVAN = "Іван Франко 0991234567 Київ 25 англія 2"
+PETRO = "Петро Мельник 0671112233 Львів 12 німеччина 3"
+
+@pytest.mark.parametrize("text, expected", [
+    (IVAN, [IVAN]),
+    (f"{IVAN}\n{PETRO}", [IVAN, PETRO]),
+    (f"1) {IVAN}\n2) {PETRO}\nпримітка: до обіду", [IVAN, f"{PETRO}\nпримітка: до обіду"]),
+    (f"{IVAN}\n---\n{PETRO}", [IVAN, PETRO]),
+    # замовлення, розкидане по абзацах, не приклеюється до наступного
+    (f"Іван Франко 0991234567\nКиїв 25\n\nанглія 2\n\n{PETRO}", ["Іван Франко 0991234567\nКиїв 25\nанглія 2", PETRO]),
+    # ПІБ окремим рядком перед телефоном належить наступному замовленню
+    (f"Іван Франко\n0991234567\nКиїв 25\nанглія 2\nПетро Мельник\n0671112233\nЛьвів 12 німеччина 3",
+     ["Іван Франко\n0991234567\nКиїв 25\nанглія 2", "Петро Мельник\n0671112233\nЛьвів 12 німеччина 3"]),
+    (f"{IVAN}\n\nПетро Мельник\n\n0671112233 Львів 12 німеччина 3",
+     [IVAN, "Петро Мельник\n0671112233 Львів 12 німеччина 3"]),
+    # той самий телефон ще раз — не нове замовлення
+    (f"{IVAN}\nтел ще раз +380991234567", [f"{IVAN}\nтел ще раз +380991234567"]),
+    (f"Іван Франко\n\n{IVAN[12:]}", [f"Іван Франко\n{IVAN[12:]}"]),
+    # другий телефон без ПІБ і країни — додатковий номер того самого замовлення
+    (f"{IVAN}\nдод. тел 0671112233", [f"{IVAN}\nдод. тел 0671112233"]),
+    (f"{IVAN}\n\nЗапасний 0505556677\n\n{PETRO}", [f"{IVAN}\nЗапасний 0505556677", PETRO]),
+])
+def test_split_bulk_orders(text, expected):
+    assert tools.split_bulk_orders(text) == expected
+
+def test_no_record_loses_a_phone():
+    text = f"Іван Франко 0991234567\nКиїв 25\n\nанглія 2\n\n{PETRO}\n\nОлена 0505556677\n\nОдеса 3 польща 1"
+    records = tools.split_bulk_orders(text)
+    assert [len(tools.phones_in(r)) for r in records] == [1, 1, 1]
+
+def test_csv_rows_skip_header():
+    content = "ПІБ;телефон;місто;відділення;товар\nІван Франко;0991234567;Київ;25;англія 2\nПетро;;Львів;1;чехія 1\n"
+    assert tools.bulk_records_from_csv(content) == ["Іван Франко 0991234567 Київ 25 англія 2", "Петро Львів 1 чехія 1"]
+
+def test_pack_texts_respects_limit():
+    import outbound
+    texts = ["x" * 1500] * 5
+    packed = outbound.pack_texts(texts)
+    assert all(len(p) <= outbound.TELEGRAM_TEXT_LIMIT for p in packed)
+    assert len(packed) == 3 and "".join(packed).count("x") == 7500
@@ -0,0 +1,54 @@
+import pytest
+
+import tools
+
+def parse(text):
+    result = tools.parse_manager_order_local(text)
+    assert result is not None
+    return result
+
+@pytest.mark.parametrize("text, name, phone, city, np, items", [
+    ("Іван Франко 0991234567 Київ 25 англія 2", "Іван Франко", "0991234567", "Київ", "25", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("Іван Франко\n0991234567\nКиїв, відділення 25\nАнглія 2 шт", "Іван Франко", "0991234567", "Київ", "25", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("Олена Шевчук 0505556677 Одеса поштомат 35628 польща 1", "Олена Шевчук", "0505556677", "Одеса", "35628", [("ПОЛЬЩА", 1)]),
+    ("Іван Якович Франко 0991234567 Київ 25 англія 2", "Іван Франко", "0991234567", "Київ", "25", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("Іван Франко Біла Церква 3 0991234567 англія 2", "Іван Франко", "0991234567", "Біла Церква", "3", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("Іван Франко 0991234567 м. Кривий Ріг 25 англія 2", "Іван Франко", "0991234567", "м. Кривий Ріг", "25", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("Іван Франко 0991234567 м. Біла Церква 25 англія 2", "Іван Франко", "0991234567", "м. Біла Церква", "25", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("Іван Франко 0991234567 с. Нова Водолага НП 3 англія 2", "Іван Франко", "0991234567", "с. Нова Водолага", "3", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("Іван Франко 0991234567 м. Київ Нова Пошта 25 англія 2", "Іван Франко", "0991234567", "м. Київ", "25", [("ВЕЛИКОБРИТАНІЯ", 2)]),
+    ("м. Київ відділення 5 Іван Франко 099 123 45 67 германія 4", "Іван Франко", "0991234567", "м. Київ", "5", [("НІМЕЧЧИНА", 4)]),
+    ("Іван Франко 0991234567 Львів 12 2 англія, 1 чехія", "Іван Франко", "0991234567", "Львів", "12",
+     [("ВЕЛИКОБРИТАНІЯ", 2), ("ЧЕХІЯ", 1)]),
+])
+def test_complete_orders(text, name, phone, city, np, items):
+    result = parse(text)
+    assert result.complete, result
+    order = result.order
+    assert (order.full_name, order.phone, order.city, order.np) == (name, phone, city, np)
+    assert sorted((i.country, i.qty) for i in order.items) == sorted(items)
+
+def test_uk_operator_attached_to_uk_only():
+    order = parse("Іван Франко 0991234567 Київ 25 англія 2 чехія 1 водафон").order
+    assert {i.country: i.operator for i in order.items} == {"ВЕЛИКОБРИТАНІЯ": "Vodafone", "ЧЕХІЯ": None}
+
+@pytest.mark.parametrize("text", [
+    "Іван м. Київ Франко 0991234567 25 англія 2",                # ПІБ розірваний назвою міста
+    "Іван Франко м. Кривий Ріг 25 0991234567 англія 2",           # ПІБ впритул до багатослівного міста
+    "Іван Франко Петренко-Іванова Олегівна 0991234567 Київ 25 англія 2",  # третє слово
+    "Іван Франко просив швидше 0991234567 Київ 25 англія 2",      # коментар
+    "Іван Франко 0991234567 0671112233 Київ 25 англія 2",         # два телефони
+    "Іван Франко 0991234567 Київ 25 англія франція 2",            # країна без кількості
+    "Іван Франко 0991234567 кур'єр Київ вул. Хрещатик 1 англія 2",  # адресна доставка
+    "Іван 0991234567 с. Тарасівка Київська обл 3 англія 1",       # область
+])
+def test_ambiguous_goes_to_gpt(text):
+    result = parse(text)
+    assert result.ambiguous and not result.complete
+
+def test_missing_fields_lower_score():
+    result = parse("Франко 0991234567 англія 2")
+    assert not result.complete and result.score == 0.6
+
+def test_no_country_is_not_an_order():
+    assert tools.parse_manager_order_local("Іван Франко 0991234567 Київ 25") is None
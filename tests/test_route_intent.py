@@ -0,0 +1,22 @@
+import pytest
+
+import tools
+
+@pytest.mark.parametrize("text, kind, countries", [
+    ("ціна англія", "prices", ["ВЕЛИКОБРИТАНІЯ"]),
+    ("прайс", "prices", ["ALL"]),
+    ("як дізнатись номер німеччина", "ussd", ["НІМЕЧЧИНА"]),
+    ("оплачу криптою", "crypto", []),
+])
+def test_confident_intents(text, kind, countries):
+    intent = tools.route_intent(text)
+    assert intent and intent.kind == kind and intent.countries == countries
+    assert intent.confidence >= 0.8
+
+@pytest.mark.parametrize("text", ["а можна оплатити криптою?", "можна оплату криптою?", "а можна криптою?"])
+def test_crypto_questions_go_to_gpt(text):
+    intent = tools.route_intent(text)
+    assert intent is None or intent.confidence < 0.8
+
+def test_quantity_is_not_a_local_intent():
+    assert tools.route_intent("англія 2") is None
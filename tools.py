@@ -1,9 +1,13 @@
 import re
+import csv
+import io
 import json
+import functools
 import logging
 from dataclasses import dataclass
-from typing import List, Dict, Optional, Set, Tuple
-from config import PRICE_TIERS, FLAGS, DISPLAY, DIAL_CODES, USSD_DATA, POST_ORDER_USSD, get_availability, CRYPTO_WALLET, CRYPTO_UAH_RATE, CRYPTO_FEE_USD
+from types import MappingProxyType
+from typing import List, Dict, Mapping, Optional, Set, Tuple
+from config import PRICE_TIERS, FLAGS, DISPLAY, DIAL_CODES, USSD_DATA, POST_ORDER_USSD, get_availability, inventory_version, CRYPTO_WALLET, CRYPTO_UAH_RATE, CRYPTO_FEE_USD
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +59,9 @@ def _extract_json_block(text: str) -> Optional[str]:
             if depth == 0:
                 return text[start:i+1]
     return None
+def has_json_block(text: str) -> bool:
+    return _extract_json_block(text or "") is not None
+
 QTY_ONLY_RE = re.compile(r"(?:\bпо\b\s*)?(\d{1,4})\s*(шт|штук|шт\.?|сим(?:-?карт[аи])?|sim-?card|sim|pieces?)\b", re.IGNORECASE)
 NUM_POS_RE = re.compile(r"\d{1,4}")
 PO_QTY_RE = re.compile(r"\bпо\s*(\d{1,4})\b", re.IGNORECASE)
@@ -109,39 +116,57 @@ COUNTRY_KEYWORDS = {
     "ЕСТОНІЯ": ["естон", "эстон", "eston", "+372"],
 }
 
+# Явні маппінги назв країн (порівнюються з назвою повністю, у верхньому регістрі)
+COUNTRY_ALIASES = {
+    "ВЕЛИКОБРИТАНІЯ": ["АНГЛІЯ", "БРИТАНІЯ", "UK", "U.K.", "UNITED KINGDOM", "ВБ", "GREAT BRITAIN", "+44", "ЮК", "У.К."],
+    "США": ["USA", "U.S.A.", "UNITED STATES", "UNITED STATES OF AMERICA", "ШТАТИ", "АМЕРИКА", "US", "U.S."],
+    "ІТАЛІЯ": ["ITALY", "ИТАЛИЯ", "ITALIA", "+39"],
+    "МОЛДОВА": ["MOLDOVA", "+373"],
+    "НІДЕРЛАНДИ": ["ГОЛЛАНДІЯ", "HOLLAND", "NETHERLANDS", "+31"],
+    "НІМЕЧЧИНА": ["ГЕРМАНІЯ", "GERMANY", "DEUTSCHLAND", "+49"],
+    "ФРАНЦІЯ": ["FRANCE", "+33"],
+    "ІСПАНІЯ": ["ИСПАНІЯ", "SPAIN", "+34"],
+    "ЧЕХІЯ": ["CZECH", "CZECH REPUBLIC", "CZECHIA", "+420"],
+    "ПОЛЬЩА": ["POLAND", "ПОЛЬША"],
+    "ЛИТВА": ["LITHUANIA"],
+    "ЛАТВІЯ": ["LATVIA"],
+    "КАЗАХСТАН": ["KAZAKHSTAN", "+7"],
+    "МАРОККО": ["MOROCCO"],
+    "ЕСТОНІЯ": ["ESTONIA", "ЭСТОНИЯ", "+372"],
+}
+
+# ==== Скомпільований пошук країн ====
+# Індекси будуються один раз при імпорті. Усі ключові слова зібрані в один regex: lookahead дає
+# збіги на кожній позиції (включно з перекриттями), тож усі згадки знаходяться за один прохід.
+_ALIAS_INDEX: Dict[str, str] = {}
+for _canonical, _aliases in COUNTRY_ALIASES.items():
+    for _alias in _aliases: _ALIAS_INDEX.setdefault(_alias, _canonical)
+_KEYWORD_INDEX: Dict[str, str] = {}
+for _canonical, _subs in COUNTRY_KEYWORDS.items():
+    for _sub in _subs: _KEYWORD_INDEX.setdefault(_sub, _canonical)
+_KEYWORD_ORDER = {key: i for i, key in enumerate(COUNTRY_KEYWORDS)}
+_KEYWORD_RE = re.compile("(?=(" + "|".join(re.escape(k) for k in sorted(_KEYWORD_INDEX, key=len, reverse=True)) + "))")
+
+def country_mentions(text_low: str) -> List[Tuple[str, int]]:
+    """Усі країни з COUNTRY_KEYWORDS у тексті (нижній регістр) з позицією першої згадки, за позицією."""
+    first: Dict[str, int] = {}
+    for m in _KEYWORD_RE.finditer(text_low):
+        first.setdefault(_KEYWORD_INDEX[m.group(1)], m.start())
+    return sorted(first.items(), key=lambda x: x[1])
+
 # ==== Допоміжні функції нормалізації ====
+@functools.lru_cache(maxsize=2048)
 def normalize_country(name: str) -> str:
     n = (name or "").strip().upper()
     # Пряме співпадіння з ключами PRICE_TIERS / DISPLAY
     if n in PRICE_TIERS or n in DISPLAY:
         return n
     # Явні маппінги
-    ALIASES = {
-        "ВЕЛИКОБРИТАНІЯ": ["АНГЛІЯ", "БРИТАНІЯ", "UK", "U.K.", "UNITED KINGDOM", "ВБ", "GREAT BRITAIN", "+44", "ЮК", "У.К."],
-        "США": ["USA", "U.S.A.", "UNITED STATES", "UNITED STATES OF AMERICA", "ШТАТИ", "АМЕРИКА", "US", "U.S."],
-        "ІТАЛІЯ": ["ITALY", "ИТАЛИЯ", "ITALIA", "+39"],
-        "МОЛДОВА": ["MOLDOVA", "+373"],
-        "НІДЕРЛАНДИ": ["ГОЛЛАНДІЯ", "HOLLAND", "NETHERLANDS", "+31"],
-        "НІМЕЧЧИНА": ["ГЕРМАНІЯ", "GERMANY", "DEUTSCHLAND", "+49"],
-        "ФРАНЦІЯ": ["FRANCE", "+33"],
-        "ІСПАНІЯ": ["ИСПАНІЯ", "SPAIN", "+34"],
-        "ЧЕХІЯ": ["CZECH", "CZECH REPUBLIC", "CZECHIA", "+420"],
-        "ПОЛЬЩА": ["POLAND", "ПОЛЬША"],
-        "ЛИТВА": ["LITHUANIA"],
-        "ЛАТВІЯ": ["LATVIA"],
-        "КАЗАХСТАН": ["KAZAKHSTAN", "+7"],
-        "МАРОККО": ["MOROCCO"],
-        "ЕСТОНІЯ": ["ESTONIA", "ЭСТОНИЯ", "+372"],
-    }
-    for canonical, aliases in ALIASES.items():
-        if n in aliases:
-            return canonical
-    # Підстрочний пошук за COUNTRY_KEYWORDS
-    n_low = n.lower()
-    for key, subs in COUNTRY_KEYWORDS.items():
-        for s in subs:
-            if s in n_low:
-                return key
+    canonical = _ALIAS_INDEX.get(n)
+    if canonical: return canonical
+    # Підстрочний пошук за COUNTRY_KEYWORDS (пріоритет — порядок словника)
+    hits = country_mentions(n.lower())
+    if hits: return min(hits, key=lambda x: _KEYWORD_ORDER[x[0]])[0]
     return n
 
 def canonical_operator(op: Optional[str]) -> Optional[str]:
@@ -206,7 +231,7 @@ def render_out_of_stock(unavailable_items: Dict[str, Optional[str]]) -> str:
     if len(lines) == 1: return f"На жаль, {lines[0][2:]}"
     return "На жаль, ці позиції наразі недоступні:\n" + "\n".join(lines)
 
-def render_price_block(country_key: str) -> str:
+def _build_price_block(country_key: str) -> str:
     flag = FLAGS.get(country_key, "")
     header_name = DISPLAY.get(country_key, country_key.title())
     header = f"{flag} {header_name} {flag}\n\n"
@@ -227,17 +252,61 @@ def render_price_block(country_key: str) -> str:
         lines.append(f"{qty_part} — {'договірна' if price is None else str(price) + ' грн'}")
     return header + "\n".join(lines) + "\n\n"
 
+def _build_available_list_text() -> str:
+    names = [DISPLAY[k] for k in PRICE_TIERS.keys() if get_availability(k)[0] == "+"]
+    if not names: return "наразі нічого немає"
+    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " та " + names[-1]
+
+# ==== Знімок прайсу ====
+# Блоки цін усіх країн, повний прайс і список наявних рендеряться один раз на версію інвентарю
+# (config.inventory_version) — запит ціни стає пошуком у словнику.
+@dataclass(frozen=True)
+class PriceSnapshot:
+    version: str
+    blocks: Mapping[str, str]  # ключ країни -> готовий блок цін
+    all_sheet: str             # блоки всіх наявних країн у порядку PRICE_TIERS
+    available_text: str
+
+_price_snapshot: Optional[PriceSnapshot] = None
+
+def _build_price_snapshot(version: str) -> PriceSnapshot:
+    blocks = {k: _build_price_block(k) for k in PRICE_TIERS}
+    all_sheet = "".join(blocks[k] for k in PRICE_TIERS if get_availability(k)[0] == "+")
+    return PriceSnapshot(version, MappingProxyType(blocks), all_sheet, _build_available_list_text())
+
+def price_snapshot() -> PriceSnapshot:
+    global _price_snapshot
+    version = inventory_version()
+    snap = _price_snapshot
+    if snap is None or snap.version != version:
+        snap = _build_price_snapshot(version)
+        _price_snapshot = snap  # атомарна заміна — читачі бачать або старий, або новий знімок
+    return snap
+
+def invalidate_price_snapshot() -> None:
+    """Примусово перебудувати знімок (напр. одразу після зміни інвентарю, не чекаючи перевірки версії)."""
+    global _price_snapshot
+    _price_snapshot = None
+    inventory_version(force=True)
+
+def render_price_block(country_key: str) -> str:
+    block = price_snapshot().blocks.get(country_key)
+    return block if block is not None else _build_price_block(country_key)
+
 def render_prices(countries: List[str]) -> str:
-    blocks = []
+    blocks = price_snapshot().blocks
+    out = []
     for c in countries:
-        key = normalize_country(c).upper()
-        if key in PRICE_TIERS: blocks.append(render_price_block(key))
-    return "".join(blocks)
+        block = blocks.get(c)  # здебільшого вже нормалізований ключ
+        if block is None: block = blocks.get(normalize_country(c).upper())
+        if block is not None: out.append(block)
+    return "".join(out)
+
+def render_all_prices() -> str:
+    return price_snapshot().all_sheet
 
 def available_list_text() -> str:
-    names = [DISPLAY[k] for k in PRICE_TIERS.keys() if get_availability(k)[0] == "+"]
-    if not names: return "наразі нічого немає"
-    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " та " + names[-1]
+    return price_snapshot().available_text
 
 def render_unavailable(unavail: List[str]) -> str:
     names = [str(x).strip() for x in unavail if str(x).strip()]
@@ -420,14 +489,34 @@ def try_parse_order_json(text: str) -> Optional[OrderData]:
         logger.warning(f"JSON parse error: {e}")
         return None
 
-def try_parse_price_json(text: str) -> Optional[List[str]]:
+@dataclass
+class PriceReply:
+    countries: List[str]
+    followup: str = ""
+    ussd_targets: Optional[List[Dict[str, str]]] = None
+    has_followup: bool = False    # модель повернула комбіновану схему — окремий follow-up не потрібен
+
+def try_parse_price_reply(text: str) -> Optional[PriceReply]:
+    """Розбирає JSON запиту цін разом з опційними полями `followup` та `ussd_targets`."""
     json_str = _extract_json_block(text or "")
     if not json_str: return None
     try:
         data = json.loads(json_str)
-        return data["countries"] if data.get("ask_prices") is True and isinstance(data.get("countries"), list) else None
+        if data.get("ask_prices") is not True or not isinstance(data.get("countries"), list): return None
+        targets = data.get("ussd_targets")
+        targets = [t for t in targets if isinstance(t, dict) and t.get("country")] if isinstance(targets, list) else []
+        return PriceReply(
+            countries=data["countries"],
+            followup=str(data.get("followup") or "").strip(),
+            ussd_targets=targets or None,
+            has_followup="followup" in data or "ussd_targets" in data,
+        )
     except Exception: return None
 
+def try_parse_price_json(text: str) -> Optional[List[str]]:
+    reply = try_parse_price_reply(text)
+    return reply.countries if reply else None
+
 def try_parse_ussd_json(text: str) -> Optional[List[Dict[str, str]]]:
     json_str = _extract_json_block(text or "")
     if not json_str: return None
@@ -441,6 +530,28 @@ def try_parse_ussd_json(text: str) -> Optional[List[Dict[str, str]]]:
 def try_parse_manager_order_json(json_text: str) -> Optional[OrderData]:
     return try_parse_order_json(json_text)
 
+# ==== Команди менеджера /stock, /price ====
+_PRICE_ARG_RE = re.compile(r"^(\d{1,5}):(\d{1,6}|-)$")
+
+def parse_stock_command(args: List[str]) -> Optional[Tuple[str, str, str]]:
+    """/stock ІСПАНІЯ - Очікуються. → ("ІСПАНІЯ", "-", "Очікуються.")"""
+    for i, a in enumerate(args):
+        if a in ("+", "-"):
+            if i == 0: return None
+            return normalize_country(" ".join(args[:i])).upper(), a, " ".join(args[i + 1:]).strip()
+    return None
+
+def parse_price_command(args: List[str]) -> Optional[Tuple[str, Dict[int, Optional[int]]]]:
+    """/price ПОЛЬЩА 10:380 4:450 1:- → ("ПОЛЬЩА", {10: 380, 4: 450, 1: None}); "-" прибирає рівень."""
+    names, changes = [], {}
+    for a in args:
+        m = _PRICE_ARG_RE.match(a)
+        if m: changes[int(m.group(1))] = None if m.group(2) == "-" else int(m.group(2))
+        elif changes: return None  # назва країни має йти перед цінами
+        else: names.append(a)
+    if not names or not changes: return None
+    return normalize_country(" ".join(names)).upper(), changes
+
 # ==== Евристики аналізу тексту ====
 def detect_qty_only(text: str) -> Optional[int]:
     if not text: return None
@@ -449,15 +560,7 @@ def detect_qty_only(text: str) -> Optional[int]:
     except: return None
 
 def _country_mentions_with_pos(text: str) -> List[Tuple[str, int]]:
-    low = (text or "").lower()
-    found = []
-    for key, subs in COUNTRY_KEYWORDS.items():
-        best = None
-        for s in subs:
-            i = low.find(s)
-            if i != -1: best = i if best is None else min(best, i)
-        if best is not None: found.append((key, best))
-    return sorted(found, key=lambda x: x[1])
+    return country_mentions((text or "").lower())
 
 def detect_point4_items(text: str) -> List[Tuple[str, int]]:
     if not text: return []
@@ -507,3 +610,289 @@ def is_meaningful_followup(text: str) -> bool:
     for p in [r"^підтверджую( наявність)?\.?$", r"^є в наявності\.?$", r"^в наявності\.?$", r"^available\.?$", r"^так, є\.?$", r"^так\.?$"]:
         if re.match(p, low): return False
     return len(t) >= 4
+
+# ==== Локальний роутер намірів (без GPT) ====
+# Однозначні короткі запити (ціни / USSD / крипто-оплата) розпізнаємо локально і віддаємо
+# той самий JSON, який повернув би GPT. Все, що не пояснюється словником, — до GPT.
+_INTENT_TOKEN_RE = re.compile(r"\+?\w+")
+_PRICE_WORD_RE = re.compile(r"^(ціна|ціни|ціну|цін|цінник\w*|цена|цены|цену|цен|прайс\w*|вартіст\w*|стоимост\w*|кошту\w*|стоит|стоят|почому|почем|price\w*)$")
+_USSD_VERB_RE = re.compile(r"^(дізна\w*|дізнат\w*|узна\w*|перевір\w*|провер\w*|подивит\w*|посмотр\w*)$")
+_USSD_WORD_RE = re.compile(r"^(ussd|юссд|комбінац\w*|комбинац\w*)$")
+_CRYPTO_WORD_RE = re.compile(r"^(крипт\w*|usdt|юсдт|тезер\w*|tether|trc|trc20|usd)$")
+_PAY_WORD_RE = re.compile(r"^(оплат\w*|оплач\w*|заплач\w*|плач\w*|плати\w*|pay\w*)$")
+_NON_COUNTRY_TOKENS = ("ukrain", "україн", "украин")
+_INTENT_FILLER = {
+    "а", "і", "й", "та", "и", "на", "по", "для", "в", "у", "з", "за", "до", "чи", "ли", "мені", "мне", "будь", "ласка",
+    "пожалуйста", "підкажіть", "подскажите", "скажіть", "скажите", "дайте", "можна", "можно", "please", "яка", "який",
+    "яку", "які", "какая", "какой", "какие", "скільки", "сколько", "що", "шо", "что", "як", "как", "свій", "мій", "свой",
+    "мой", "номер", "номера", "телефону", "сім", "сімки", "сімку", "сімка", "симки", "симку", "sim", "карта", "карти",
+    "карту", "картки", "карты", "вас", "є", "ще", "привіт", "добрий", "день", "вечір", "здравствуйте", "доброго",
+    "hello", "hi", "the", "of", "for", "a", "зараз", "сейчас", "буду", "хочу", "через",
+}
+
+@dataclass
+class LocalIntent:
+    kind: str                     # "prices" | "ussd" | "crypto"
+    countries: List[str]
+    confidence: float
+
+    def as_gpt_json(self) -> str:
+        """Повертає JSON у тому ж форматі, що й основний GPT-промпт."""
+        if self.kind == "prices":
+            return json.dumps({"ask_prices": True, "countries": self.countries, "followup": ""}, ensure_ascii=False)
+        if self.kind == "ussd":
+            return json.dumps({"ask_ussd": True, "targets": [{"country": c} for c in self.countries]}, ensure_ascii=False)
+        return json.dumps({"crypto_payment": True})
+
+def _is_country_token(tok: str) -> bool:
+    if tok.startswith(_NON_COUNTRY_TOKENS): return False
+    return _KEYWORD_RE.search(tok) is not None
+
+def route_intent(text: str) -> Optional[LocalIntent]:
+    """Класифікує коротке повідомлення як запит цін / USSD / крипто-оплати. None — якщо не впевнені."""
+    t = (text or "").strip()
+    if not t or len(t) > 80: return None
+    low = t.lower()
+    if any(low.startswith(p) for p in _NON_COUNTRY_TOKENS): return None
+    tokens = _INTENT_TOKEN_RE.findall(low)
+    if not tokens: return None
+
+    explained, kinds = 0, set()
+    has_ussd_verb = False
+    for tok in tokens:
+        if _PRICE_WORD_RE.match(tok): kinds.add("prices")
+        elif _USSD_WORD_RE.match(tok): kinds.add("ussd")
+        elif _USSD_VERB_RE.match(tok): has_ussd_verb = True
+        elif _CRYPTO_WORD_RE.match(tok): kinds.add("crypto")
+        elif _PAY_WORD_RE.match(tok): pass
+        elif _is_country_token(tok): pass
+        elif tok in _INTENT_FILLER: pass
+        elif tok.isdigit(): return None  # кількість → це вже схоже на замовлення
+        else: continue
+        explained += 1
+    if has_ussd_verb and ("номер" in tokens or "номера" in tokens): kinds.add("ussd")
+    if len(kinds) != 1: return None
+
+    kind = kinds.pop()
+    countries = [c for c, _ in _country_mentions_with_pos(low)] if kind != "crypto" else []
+    confidence = explained / len(tokens)
+    if kind == "ussd" and not countries: return None  # країну має уточнити GPT
+    if kind == "prices" and not countries: countries = ["ALL"]
+    if kind == "crypto" and "?" in t: confidence *= 0.7  # «а можна оплатити криптою?» — це питання, а не вибір
+    return LocalIntent(kind=kind, countries=countries, confidence=round(confidence, 2))
+
+# ==== Локальний розбір замовлення менеджера (без GPT) ====
+# Менеджери здебільшого пишуть за одним шаблоном: «Іван Франко 0991234567 Київ 25 англія 2».
+# Такі повідомлення розбираємо правилами; до GPT — лише якщо якогось поля бракує або в тексті
+# лишилось щось непояснене (коментарі, адресна доставка, область, кілька телефонів тощо).
+_MGR_PHONE_RE = re.compile(r"(?<![\d+])(?:\+?38[\s\-]?)?\(?0\d{2}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}(?!\d)")
+_MGR_NP_RE = re.compile(r"(?:\bвідділенн\w*|\bвідд?\.|\bпоштомат\w*|\bнп\b|\bнова\s+пошта\b|№)\s*(?:№\s*)?(\d{1,5})(?!\d)", re.IGNORECASE)
+_MGR_SETTLEMENT_RE = re.compile(r"(?<!\w)(м\.|місто|с\.|село|смт\.?|пгт\.?)[ \t]*(?=[^\W\d_])", re.IGNORECASE)
+_MGR_CITY_WORDS = {"нова"}  # «с. Нова Водолага»; «Нова Пошта 25» до цього вже прибрано як відділення
+_MGR_CITY_WORD_RE = re.compile(r"[ \t]*([^\W\d_][\w'’\-]*)")
+_MGR_SETTLEMENT_STD = {"м.": "м.", "місто": "м.", "с.": "с.", "село": "с.", "смт": "смт.", "смт.": "смт.", "пгт": "смт.", "пгт.": "смт."}
+_MGR_GPT_ONLY_RE = re.compile(r"кур['’`]?єр|адресн|на адресу|\bвул\.|\bвулиц|\bпросп|\bобл\b|\bобл\.|област|район|р-н", re.IGNORECASE)
+_MGR_TOKEN_RE = re.compile(r"[^\W\d_][\w'’\-]*|\d+|[^\w\s]|\n")
+_MGR_PATRONYMIC_RE = re.compile(r"(ович|евич|євич|йович|івна|ївна|овна|евна|ічна|інічна)$", re.IGNORECASE)
+_MGR_FILLER = {
+    "тел", "телефон", "номер", "шт", "штук", "штуки", "сім", "сімка", "сімки", "сімок", "сім-карта", "сім-карти",
+    "сім-карт", "сімкарти", "sim", "карта", "карти", "карт", "оператор", "оператора", "і", "та", "й", "по", "нова",
+    "пошта", "відділення", "поштомат", "нп", "замовлення", "клієнт",
+}
+
+@dataclass
+class LocalOrder:
+    order: OrderData
+    score: float      # частка заповнених полів: ПІБ, телефон, місто, відділення, товари
+    ambiguous: bool   # у тексті є те, що правила не пояснюють однозначно
+
+    @property
+    def complete(self) -> bool:
+        return self.score >= 1.0 and not self.ambiguous
+
+def _mask(text: str, start: int, end: int) -> str:
+    """Прибирає фрагмент, зберігаючи позиції решти тексту (детектор товарів рахує відстані)."""
+    return text[:start] + "|" * (end - start) + text[end:]
+
+def _is_manager_word(word: str) -> bool:
+    """Слово, яке може бути частиною ПІБ чи назви міста."""
+    low = word.lower()
+    return low not in _MGR_FILLER and not _is_country_token(low) and canonical_operator(low) is None
+
+def parse_manager_order_local(text: str) -> Optional[LocalOrder]:
+    """Розбирає замовлення менеджера правилами. None — якщо в тексті немає жодної країни."""
+    t = (text or "").strip()
+    if not t or not country_mentions(t.lower()): return None
+    ambiguous = bool(_MGR_GPT_ONLY_RE.search(t))
+    work = t
+
+    phones = []
+    for m in _MGR_PHONE_RE.finditer(t):
+        phones.append(re.sub(r"\D", "", m.group(0)))
+        work = _mask(work, m.start(), m.end())
+    if len({p[-9:] for p in phones}) > 1: ambiguous = True
+    for m in PAID_HINT_RE.finditer(work): work = _mask(work, m.start(), m.end())
+
+    np_value, np_pos = "", None
+    np_matches = list(_MGR_NP_RE.finditer(work))
+    if np_matches:
+        m = np_matches[0]
+        np_value, np_pos = m.group(1), m.start()
+        work = _mask(work, m.start(), m.end())
+        if len(np_matches) > 1: ambiguous = True
+
+    city, settlement_span = "", None
+    settlements = list(_MGR_SETTLEMENT_RE.finditer(work))
+    if settlements:
+        # Назва після «м.»/«с.» — усі слова до номера відділення, телефону чи країни («м. Кривий Ріг 25»)
+        m = settlements[0]
+        words, end = [], m.end()
+        while True:
+            w = _MGR_CITY_WORD_RE.match(work, end)
+            if not w or not (_is_manager_word(w.group(1)) or w.group(1).lower() in _MGR_CITY_WORDS): break
+            words.append(w.group(1))
+            end = w.end()
+        city = " ".join([_MGR_SETTLEMENT_STD[m.group(1).lower()]] + words)
+        settlement_span = (m.start(), end)
+        work = _mask(work, m.start(), end)
+        if len(settlements) > 1: ambiguous = True
+
+    # Слова-кандидати на ПІБ/місто, згруповані в «ряди» без розділювачів між ними
+    tokens = list(_MGR_TOKEN_RE.finditer(work))
+    runs: List[List[re.Match]] = []
+    current: List[re.Match] = []
+    bare_np = []
+    for i, tok in enumerate(tokens):
+        s = tok.group(0)
+        if s[0].isalpha() and _is_manager_word(s):
+            current.append(tok)
+            continue
+        if current: runs.append(current); current = []
+        # «Київ 25» без слова «відділення»: число одразу після назви — номер відділення
+        if s.isdigit() and i > 0 and tokens[i - 1] is (runs[-1][-1] if runs else None): bare_np.append(tok)
+        elif s.isdigit() and settlement_span and not work[settlement_span[1]:tok.start()].strip(" ,|"): bare_np.append(tok)
+    if current: runs.append(current)
+    runs = [r for r in ([t for t in run if not _MGR_PATRONYMIC_RE.search(t.group(0))] for run in runs) if r]
+    if np_pos is None and bare_np:
+        m = bare_np[0]
+        np_value, np_pos = m.group(0), m.start()
+        work = _mask(work, m.start(), m.end())
+        if len(bare_np) > 1: ambiguous = True
+
+    city_run = None
+    if np_pos is not None:
+        for run in runs:
+            if run[-1].end() <= np_pos and not work[run[-1].end():np_pos].strip(" ,"):
+                city_run = run
+    name_runs = [r for r in runs if r is not city_run]
+    if city_run and not city:
+        if not name_runs and len(city_run) >= 3:
+            name_runs, city_run = [city_run[:2]], city_run[2:]  # «Іван Франко Біла Церква 3»
+        city = " ".join(tok.group(0) for tok in city_run)
+    elif city_run: name_runs.append(city_run)
+    name_tokens = [tok for run in name_runs for tok in run]
+    name_words = [tok.group(0) for tok in name_tokens]
+    if len(name_words) > 2: ambiguous = True  # третє слово — подвійне прізвище, частина міста чи коментар: хай читає GPT
+    if settlement_span:
+        before = [t for t in name_tokens if t.end() <= settlement_span[0]]
+        glued = bool(before) and not work[before[-1].end():settlement_span[0]].strip() and len(city.split()) > 2
+        if glued or (before and any(t.start() >= settlement_span[1] for t in name_tokens)):
+            ambiguous = True  # ПІБ впритул до «м. …» або по обидва боки — незрозуміло, де закінчується назва міста
+
+    items = [(c, q) for c, q in detect_point4_items(work) if 1 <= q <= 999]
+    if len(items) < len(country_mentions(work.lower())) or len(NUM_POS_RE.findall(work)) > len(items): ambiguous = True
+    operator = next((canonical_operator(tok.group(0)) for tok in tokens if tok.group(0)[0].isalpha() and canonical_operator(tok.group(0))), None)
+    order = OrderData(
+        full_name=" ".join(name_words) if len(name_words) <= 2 else "",
+        phone=phones[0] if phones else "",
+        city=city,
+        np=np_value,
+        items=[OrderItem(country=c, qty=q, operator=operator if c == "ВЕЛИКОБРИТАНІЯ" else None) for c, q in items],
+    )
+    filled = [order.full_name, order.phone, order.city, order.np, order.items]
+    return LocalOrder(order=order, score=round(sum(1 for f in filled if f) / len(filled), 2), ambiguous=ambiguous)
+
+# ==== Пакетний імпорт замовлень менеджера ====
+# Кілька замовлень в одному повідомленні (або у файлі .txt/.csv) діляться на записи: порожні рядки,
+# рядки-розділювачі (---, ===, …) і нумерація «1)», «2.» на початку рядка. Межа запису — новий телефон:
+# фрагмент з іншим телефоном завжди починає окреме замовлення (навіть усередині абзацу), а фрагмент
+# без телефону (примітка, продовження адреси, «англія 2» окремим абзацом) дописується до попереднього.
+_BULK_SEPARATOR_RE = re.compile(r"^\s*(?:[-=_—–*#.…~]{3,})?\s*$")
+_BULK_NUMBER_RE = re.compile(r"^\s*\d{1,3}\s*[).]\s+(?=\D)")
+
+def phones_in(text: str) -> Set[str]:
+    """Різні телефони в тексті (останні 9 цифр — «+380…» і «0…» збігаються)."""
+    return {re.sub(r"\D", "", m.group(0))[-9:] for m in _MGR_PHONE_RE.finditer(text or "")}
+
+def _is_name_line(line: str) -> bool:
+    """Рядок лише з ПІБ («Петро Мельник») — належить замовленню, що йде після нього."""
+    words = line.split()
+    return 1 <= len(words) <= 3 and all(w[:1].isupper() and w.replace("-", "").replace("'", "").isalpha() for w in words) \
+        and not country_mentions(line.lower())
+
+_BULK_PHONE_LABELS = {"дод", "додатковий", "другий", "запасний", "моб", "мобільний", "ще"}
+
+def _opens_record(text: str) -> bool:
+    """Фрагмент з новим телефоном відкриває нове замовлення, лише якщо в ньому є ПІБ або країна —
+    «дод. тел 067…» належить поточному замовленню."""
+    rest = _MGR_PHONE_RE.sub(" ", text)
+    if country_mentions(rest.lower()): return True
+    return any(w[:1].isupper() and _is_manager_word(w) and w.lower() not in _BULK_PHONE_LABELS
+               for w in re.findall(r"[^\W\d_][\w'’\-]*", rest))
+
+def _split_by_phone(lines: List[str]) -> List[List[str]]:
+    pieces: List[List[str]] = [[]]
+    seen: Set[str] = set()
+    for line in lines:
+        phones = phones_in(line)
+        if phones - seen and seen:
+            carry = [pieces[-1].pop()] if len(pieces[-1]) > 1 and _is_name_line(pieces[-1][-1]) else []
+            if carry or _opens_record(line):
+                pieces.append(carry)
+                seen = set()
+        seen |= phones
+        pieces[-1].append(line)
+    return [p for p in pieces if p]
+
+def _merge_bulk_pieces(pieces: List[str]) -> List[str]:
+    records: List[str] = []
+    record_phones: Set[str] = set()
+    pending = ""  # фрагменти без телефону, що належать наступному запису
+    for i, piece in enumerate(pieces):
+        phones = phones_in(piece)
+        if phones and (not records or (phones - record_phones and (pending or _opens_record(piece)))):
+            records.append(f"{pending}\n{piece}".strip() if pending else piece)
+            record_phones, pending = set(phones), ""
+            continue
+        record_phones |= phones
+        next_has_phone = i + 1 < len(pieces) and bool(phones_in(pieces[i + 1]) - record_phones)
+        if records and not (next_has_phone and _is_name_line(piece)): records[-1] += "\n" + piece
+        else: pending = f"{pending}\n{piece}".strip()
+    if pending:
+        if records: records[-1] += "\n" + pending
+        else: records.append(pending)
+    return records
+
+def split_bulk_orders(text: str) -> List[str]:
+    """Ділить текст на окремі замовлення. Один елемент — звичайне (одиночне) замовлення."""
+    chunks, current = [], []
+    for line in (text or "").splitlines():
+        if _BULK_SEPARATOR_RE.match(line):
+            if current: chunks.append(current); current = []
+            continue
+        m = _BULK_NUMBER_RE.match(line)
+        if m:
+            if current: chunks.append(current); current = []
+            line = line[m.end():]
+        current.append(line.strip())
+    if current: chunks.append(current)
+    return _merge_bulk_pieces(["\n".join(p) for chunk in chunks for p in _split_by_phone(chunk)])
+
+def bulk_records_from_csv(content: str) -> List[str]:
+    """Рядки CSV → тексти замовлень (клітинки через пробіл). Заголовок без телефону пропускається."""
+    try: dialect = csv.Sniffer().sniff(content[:4096], delimiters=",;\t")
+    except csv.Error: dialect = csv.excel
+    rows = [" ".join(c.strip() for c in row if c.strip()) for row in csv.reader(io.StringIO(content), dialect)]
+    rows = [r for r in rows if r]
+    if rows and not _MGR_PHONE_RE.search(rows[0]): rows = rows[1:]
+    return rows